@@ -2,12 +2,16 @@
 from __future__ import unicode_literals
 
 import os
+import zlib
+import time
 import codecs
-
+import collections
 try:
-    from itertools import izip as zip
-except ImportError:
-    pass
+    import lzma
+except ImportError:  # pragma: no cover # Python built without liblzma
+    lzma = None
+from hashlib import blake2b, sha256
+from concurrent.futures import ThreadPoolExecutor
 
 __version__ = (1, 2, 4)
 
@@ -15,28 +19,251 @@ __version__ = (1, 2, 4)
 class FragmentsError(Exception): pass
 
 
+_racy_window = 10**9  # nanoseconds; files modified this recently may change again without their mtime changing
+_chunk_size = 64 * 1024
+objects_directory_name = 'objects'
+weaves_directory_name = 'weaves'
+
+_compressors = {  # {compression: (file name suffix, compress, decompress)}
+    'zlib': ('.z', zlib.compress, zlib.decompress),
+}
+if lzma is not None:
+    _compressors['lzma'] = ('.xz', lzma.compress, lzma.decompress)
+
+
+def _digest(data=b''):
+    return blake2b(data, digest_size=16)
+
+
+def _file_digest(path):
+    """Returns the hex digest of a file's contents"""
+    digest = _digest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stat_signature(stat_result):
+    """Returns the stat fields that change when a file's contents change: size, mtime, inode and ctime"""
+    return [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, stat_result.st_ctime_ns]
+
+
+def _compare_files(repo_path, curr_path):
+    """Compares two files chunk by chunk, stopping at the first difference. Returns the digest of their contents if they match, None if not"""
+    digest = _digest()
+    with open(repo_path, 'rb') as repo_file:
+        with open(curr_path, 'rb') as curr_file:
+            while True:
+                repo_chunk = repo_file.read(_chunk_size)
+                if repo_chunk != curr_file.read(_chunk_size):
+                    return None
+                if not repo_chunk:
+                    return digest.hexdigest()
+                digest.update(repo_chunk)
+
+
+def _index_entry(config, key, repo_signature):
+    """Returns the index entry for key, if it still describes the committed version"""
+    entry = config.index.get(key)
+    if entry is not None and entry['repo'] == repo_signature:
+        return entry
+
+
+def _update_index(config, key, repo_signature, curr_stat, digest=None):
+    """
+    Records the stat data of a file that matches its committed version, so later status checks can skip comparing contents,
+    along with the digest of the committed contents, if known, so later checks never need to read the committed file.
+    """
+    entry = {'repo': repo_signature}
+    if digest is None:
+        digest = (_index_entry(config, key, repo_signature) or {}).get('digest')
+    if digest is not None:
+        entry['digest'] = digest
+    curr_signature = _stat_signature(curr_stat)
+    if curr_signature[1] < time.time() * 10**9 - _racy_window:  # otherwise racily clean: a change within the same mtime tick would go unnoticed
+        entry['curr'] = curr_signature
+    config.index[key] = entry
+
+
+def _snapshot_suffix(config):
+    compression = config.get('compression')
+    return _compressors[compression][0] if compression else ''
+
+
+def _compress(config, contents):
+    compression = config.get('compression')
+    return _compressors[compression][1](contents) if compression else contents
+
+
+def _decompress(config, contents):
+    compression = config.get('compression')
+    return _compressors[compression][2](contents) if compression else contents
+
+
+def _object_path(config, object_id):
+    return os.path.join(config.directory, objects_directory_name, object_id[:2], object_id[2:]) + _snapshot_suffix(config)
+
+
+def _weave_path(config, key):
+    """Returns the path of the weave holding the committed versions of the files in key's directory"""
+    directory_key = os.path.dirname(key)
+    return os.path.join(config.directory, weaves_directory_name, sha256(('%s:%s' % (__package__, directory_key)).encode('utf8')).hexdigest()) + _snapshot_suffix(config)
+
+
+def _stored_path(config, value):
+    """Returns the path of the committed version stored under value in config['files'], or None if it is not stored in a file of its own"""
+    storage = config.get('storage', 'flat')
+    if storage == 'objects':
+        return _object_path(config, value) if value else None
+    elif storage == 'weave':
+        return None
+    return os.path.join(config.directory, value) + _snapshot_suffix(config)
+
+
+def _snapshot_path(config, key):
+    """
+    Returns the path of the committed version of the followed file key, or None if it has never been committed, or is stored in a weave.
+    With the flat storage, committed versions are named after a hash of the file's path, in the _fragments/ directory;
+    with the objects storage, they are named after the digest of their contents, in _fragments/objects/, and shared by identical files.
+    With the weave storage, they are revisions, named after the digest of their contents, in one weave per directory in _fragments/weaves/.
+    """
+    return _stored_path(config, config['files'][key])
+
+
+def _snapshot_signature(config, key):
+    """Returns data that changes whenever the committed version of key changes, or None if it has never been committed"""
+    if config.get('storage') == 'weave':
+        digest = config['files'][key]
+        return [digest] if digest else None  # revisions are named after their contents, so are never modified
+    path = _snapshot_path(config, key)
+    if path is None or not os.access(path, os.R_OK|os.W_OK):
+        return None
+    return _stat_signature(os.stat(path))[:3]  # renaming the committed file changes its ctime but not its contents
+
+
+def _read_snapshot(config, key):
+    """Returns the committed contents of key as bytes, decompressing them if needed"""
+    if config.get('storage') == 'weave':
+        return ''.join(_snapshot_lines(config, key)).encode('utf8')
+    with open(_snapshot_path(config, key), 'rb') as repo_file:
+        return _decompress(config, repo_file.read())
+
+
+def _snapshot_lines(config, key):
+    """Returns the committed lines of key, as _smart_open(path).readlines() would"""
+    if config.get('storage') == 'weave':
+        return config.weaves.load(_weave_path(config, key)).retrieve_revision(config['files'][key])
+    return _read_snapshot(config, key).decode('utf8').splitlines(True)
+
+
+def _snapshot_digest(config, key):
+    """Returns the digest of the committed contents of key, only reading them if the index does not know it"""
+    if config.get('storage', 'flat') != 'flat':
+        return config['files'][key]  # objects and revisions are named after the digest of their contents
+    digest = (_index_entry(config, key, _snapshot_signature(config, key)) or {}).get('digest')
+    if digest is None:
+        digest = _digest(_read_snapshot(config, key)).hexdigest()
+    return digest
+
+
+def _refresh_lines(config, key):
+    """Rebuilds the line index rows of the committed file key if they are missing, or were made from a committed version since replaced some other way"""
+    digest = _snapshot_digest(config, key)
+    if not config.lines.describes(key, digest):
+        config.lines.add(key, _snapshot_lines(config, key), digest)
+
+
+def _write_snapshot(config, key, contents, curr_stat, digest):
+    """Stores contents, as bytes with the given hex digest, as the committed version of key"""
+    config.lines.add(key, contents.decode('utf8').splitlines(True), digest)
+    storage = config.get('storage', 'flat')
+    if storage == 'weave':
+        path = _weave_path(config, key)
+        weave = config.weaves.load(path)
+        if digest not in weave.parents:  # identical files in the same directory share a revision
+            weave.add_revision(digest, contents.decode('utf8').splitlines(True), [])
+            config.weaves.changed.add(path)
+        config['files'][key] = digest
+    elif storage == 'objects':
+        path = _object_path(config, digest)
+        if not os.path.exists(path):  # objects are never modified once written, so an existing one already has these contents
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'wb') as object_file:
+                object_file.write(_compress(config, contents))
+            os.rename(path + '.tmp', path)
+        config['files'][key] = digest
+    else:
+        path = _snapshot_path(config, key)
+        with open(path, 'wb') as repo_file:
+            repo_file.write(_compress(config, contents))
+        os.utime(path, curr_stat[7:9])
+
+
+def _remove_snapshots(config, removed):
+    """
+    Removes committed versions that were replaced or forgotten, given as [(key, value)] of their old entries in config['files'],
+    unless another followed file still shares them.
+    """
+    storage = config.get('storage', 'flat')
+    if storage == 'weave':
+        removed = [(key, digest) for key, digest in removed if digest]
+        if not removed:
+            return
+        referenced = set((os.path.dirname(key), digest) for key, digest in config['files'].items() if digest)  # revisions are shared within a directory
+        for key, digest in removed:
+            if (os.path.dirname(key), digest) not in referenced:
+                path = _weave_path(config, key)
+                weave = config.weaves.load(path)
+                if digest in weave.parents:
+                    weave.remove_revision(digest)
+                    config.weaves.changed.add(path)
+        return
+    if storage == 'objects':
+        referenced = set(config['files'].values())
+        removed = [(key, value) for key, value in removed if value not in referenced]
+    for path in set(_stored_path(config, value) for key, value in removed):
+        if path is not None and os.access(path, os.W_OK):
+            os.unlink(path)
+
+
 def _file_status(config, curr_path):
     key = curr_path[len(config.root)+1:]
     if key not in config['files']:
         return '?'  # unfollowed
 
-    repo_path = os.path.join(config.directory, config['files'][key])
+    repo_signature = _snapshot_signature(config, key)
 
-    repo_exists = os.access(repo_path, os.R_OK|os.W_OK)
+    repo_exists = repo_signature is not None
     curr_exists = os.access(curr_path, os.R_OK|os.W_OK)
 
     if repo_exists and curr_exists:
-        if os.stat(repo_path)[6] != os.stat(curr_path)[6]:
+        curr_stat = os.stat(curr_path)
+        storage = config.get('storage', 'flat')
+        compressed = bool(config.get('compression'))
+        if storage != 'weave' and not compressed and repo_signature[0] != curr_stat.st_size:
             return 'M'  # current and repo versions have different sizes: file has been modified
+        entry = _index_entry(config, key, repo_signature)
+        known_digest = (entry or {}).get('digest')
+        if storage != 'flat':
+            known_digest = config['files'][key]  # objects and revisions are named after the digest of their contents
+        if entry is not None and entry.get('curr') == _stat_signature(curr_stat):
+            return ' '  # neither file has been touched since they were last known to match: file is unmodified
+        if known_digest is None and compressed:
+            known_digest = _digest(_read_snapshot(config, key)).hexdigest()  # only when the index has no digest for it
+        if known_digest is not None:
+            digest = _file_digest(curr_path)
+            if digest != known_digest:
+                return 'M'  # current version does not hash to the committed version's digest: file has been modified
+            _update_index(config, key, repo_signature, curr_stat, digest)
+            return ' '  # current version hashes to the committed version's digest: file is unmodified
         else:
-            with open(repo_path, 'r') as repo_file:
-                with open(curr_path, 'r') as curr_file:
-                    for repo_line, curr_line in zip(repo_file.readlines(), curr_file.readlines()):
-                        if len(repo_line) != len(curr_line):
-                            return 'M'  # corresponding lines have different length: file has been modified
-                        if repo_line != curr_line:
-                            return 'M'  # corresponding lines are different: file has been modified
-                    return ' '  # current and repo versions are the same size, corresponding lines are all the same length and all match: file is unmodified
+            digest = _compare_files(_snapshot_path(config, key), curr_path)
+            if digest is None:
+                return 'M'  # current and repo versions differ somewhere: file has been modified
+            _update_index(config, key, repo_signature, curr_stat, digest)
+            return ' '  # current and repo versions are the same size and all their bytes match: file is unmodified
     elif repo_exists:
         return 'D'  # deleted
     elif curr_exists:
@@ -45,30 +272,122 @@ def _file_status(config, curr_path):
         return 'E'  # error. this should never happen - both files on disk are missing, but file is being followed
 
 
-def _expand(dirpath):
-    for path, dirs, files in os.walk(dirpath):
-        for filename in files:
-            yield os.path.join(path, filename)
+def _expand(config, dirpath):
+    """
+    Yields every file below dirpath in sorted order, except ignored files,
+    without descending into ignored or symlinked directories or the _fragments/ directory.
+    Followed files are never ignored, so followed files in ignored directories are yielded without listing those directories.
+    """
+    root_prefix = os.path.join(config.root, '')
+    pending = [(dirpath, True)]
+    while pending:
+        path, is_dir = pending.pop()
+        if is_dir is None:  # ignored directory with followed files below it
+            for followed_path in _expand_followed(config, path):
+                yield followed_path
+            continue
+        if not is_dir:
+            yield path
+            continue
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue  # unreadable or vanished directory, os.walk() ignores these too
+        children = []
+        for entry in entries:
+            is_dir = entry.is_dir()
+            if config.ignore and entry.path.startswith(root_prefix):
+                key = entry.path[len(root_prefix):]
+                if config.ignore.match(key.replace(os.sep, '/'), is_dir):
+                    if is_dir and not entry.is_symlink() and config.followed(os.path.join(key, '')):
+                        children.append((entry.name + os.sep, entry.path, None))
+                    elif not is_dir and key in config['files']:
+                        children.append((entry.name, entry.path, False))
+                    continue
+            if is_dir:
+                if not entry.is_symlink() and entry.path != config.directory:
+                    children.append((entry.name + os.sep, entry.path, True))
+            else:
+                children.append((entry.name, entry.path, False))
+        children.sort(reverse=True)  # sorting directories by name + separator makes the walk visit paths in sorted order
+        pending.extend((child_path, child_is_dir) for name, child_path, child_is_dir in children)
+
+
+def _expand_followed(config, dirpath):
+    """Yields every followed file below dirpath that exists on disk, without listing any directories"""
+    prefix = os.path.join(dirpath, '')
+    root_prefix = os.path.join(config.root, '')
+    if prefix.startswith(root_prefix):
+        keys = config.followed(prefix[len(root_prefix):])
+    elif root_prefix.startswith(prefix):
+        keys = config.followed()
+    else:
+        return
+    for key in keys:
+        path = os.path.join(config.root, key)
+        if os.path.isfile(path):
+            yield path
+
+
+def _ordered_map(function, iterable, jobs=1, executor=None):
+    """Like map(), but calls function on up to jobs worker threads (or in executor, if given) at once, still yielding results in order"""
+    if jobs <= 1:
+        for item in iterable:
+            yield function(item)
+        return
+    with (executor or ThreadPoolExecutor(max_workers=jobs)) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            if len(pending) >= jobs * 2:  # don't run ahead of the consumer
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
 
 
-def _files_by_status(config, dirpath, statuses='MDAE '):
-    for path in _expand(dirpath):
-        status = _file_status(config, path)
+_watched_statuses = None  # {path: status} kept current by a Watcher; only the server turns this on, see _use_watched_statuses()
+
+
+def _use_watched_statuses(statuses=None):
+    """Take the status of followed files from statuses instead of checking them, until called again without statuses"""
+    global _watched_statuses
+    _watched_statuses = statuses
+
+
+def _current_status(config, path):
+    if _watched_statuses is not None and path in _watched_statuses:
+        return _watched_statuses[path]
+    return _file_status(config, path)
+
+
+def _files_by_status(config, dirpath, statuses='MDAE ', jobs=1):
+    def _path_status(path):
+        return _current_status(config, path), path
+    if '?' in statuses:
+        paths = _expand(config, dirpath)
+    else:
+        paths = _expand_followed(config, dirpath)  # only followed files can have any other status
+    for status, path in _ordered_map(_path_status, paths, jobs=jobs):
         if status in statuses:
             yield (status, path)
 
 
-def _iterate_over_files(args, config, statuses='MDAE '):
+def _iterate_over_files(args, config, statuses='MDAE ', jobs=1, stream=False):
+    """
+    Yields (status, path) for args, expanding directories, sorted by status and path within each directory.
+    If stream is True, files in directories are yielded as soon as their status is known, sorted by path only.
+    """
     seen = set()
     for a in sorted(args):
         if a not in seen:
             seen.add(a)
             path = os.path.realpath(a)
             if os.path.isdir(path):
-                for status, path in sorted(_files_by_status(config, path, statuses=statuses)):
+                files = _files_by_status(config, path, statuses=statuses, jobs=jobs)
+                for status, path in (files if stream else sorted(files)):
                     yield status, path
             else:
-                yield _file_status(config, path), path
+                yield _current_status(config, path), path
 
 
 def _smart_open(path, mode='r'):
@@ -2,64 +2,193 @@
 from __future__ import unicode_literals
 
 import os
+import json
+import zlib
 import argparse
+import functools
+import collections
+from concurrent.futures import ProcessPoolExecutor
 
-from . import _iterate_over_files, _smart_open
+from . import _digest, _file_digest, _ordered_map, _iterate_over_files, _smart_open, _snapshot_signature, _snapshot_lines, _refresh_lines
 from .precisecodevillemerge import Weave
-from .config import FragmentsConfig
+from .config import FragmentsConfig, _line_digest
 from .diff import _diff_group, _split_diff
 from .color import Prompt
 
 
-def apply(*args):
+cache_directory_name = 'cache'
+
+
+class WeaveCache(object):
+    """
+    Weaves built by apply, kept in _fragments/cache/ so applying the same changes again does not have to match the same lines again.
+    Each cached weave is named after a digest of the revisions added to it, so a changed revision makes a new weave instead of reusing a stale one.
+    Outcomes of merging a weave's changes into target files that don't need the merged contents, skipping or leaving the file as it is, are kept too.
     """
-    Apply changes in SOURCE_FILENAME that were made since last commit, where possible.
-    Limit application to TARGET_FILENAME(s) if specified.
-    Files that conflict in their entirety will be skipped.
-    Smaller conflicts will be written to the file as conflict sections.
 
-    In interactive mode, you can use the following commands:
+    format_header = b'fragments weave cache 2\n'
+    size = 32  # number of cached weaves to keep, the least recently used are removed
+    outcomes_file_name = 'outcomes.json'
+    outcomes_format_version = 1
+    outcomes_size = 4096  # number of merge outcomes to keep, the least recently used are removed
 
-        y - include this change
-        n - do not include this change
-        a - include this change and all remaining changes
-        d - done, do not include this change nor any remaining changes
-        j - leave this change undecided, see next undecided change
-        k - leave this change undecided, see previous undecided change
-        ? - interactive apply mode help
+    def __init__(self, config):
+        self.directory = os.path.join(config.directory, cache_directory_name)
+        self.outcomes = None  # {weave name:target digest: outcome}, least recently used first
+
+    def _load_outcomes(self):
+        if self.outcomes is None:
+            self.outcomes = collections.OrderedDict()
+            try:
+                with open(os.path.join(self.directory, self.outcomes_file_name), 'r') as outcomes_file:
+                    stored = json.loads(outcomes_file.read())
+                if stored['format'] == self.outcomes_format_version:
+                    self.outcomes.update(stored['outcomes'])
+            except (EnvironmentError, ValueError, KeyError, TypeError):
+                self.outcomes.clear()  # missing or corrupt, start over
+        return self.outcomes
+
+    def outcome(self, name, target_digest):
+        """Returns the recorded outcome of merging the changes in the weave named name into a file with target_digest, or None"""
+        key = '%s:%s' % (name, target_digest)
+        outcome = self._load_outcomes().get(key)
+        if outcome is not None:
+            self.outcomes.move_to_end(key)
+        return outcome
+
+    def record(self, name, target_digest, outcome):
+        key = '%s:%s' % (name, target_digest)
+        self._load_outcomes()[key] = outcome
+        self.outcomes.move_to_end(key)
+        while len(self.outcomes) > self.outcomes_size:
+            self.outcomes.popitem(last=False)
+
+    def dump_outcomes(self):
+        if self.outcomes is None:
+            return
+        path = os.path.join(self.directory, self.outcomes_file_name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + '.tmp', 'w') as outcomes_file:
+                outcomes_file.write(json.dumps({'format': self.outcomes_format_version, 'outcomes': list(self.outcomes.items())}))
+            os.rename(path + '.tmp', path)
+        except EnvironmentError:
+            pass
+
+    def add_revisions(self, weave, name, revisions):
+        """Adds [(revid, lines, parents)] to weave, which is named name. Returns the resulting weave and its name, loading it from the cache if possible"""
+        for revid, lines, parents in revisions:
+            content_digest = _digest(''.join(lines).encode('utf8')).hexdigest()
+            name = _digest(json.dumps([name, revid, content_digest, parents]).encode('utf8')).hexdigest()
+        cached = self._load(name)
+        if cached is not None:
+            return cached, name
+        for revid, lines, parents in revisions:
+            weave.add_revision(revid, lines, parents)
+        self._dump(name, weave)
+        return weave, name
+
+    def _load(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as cache_file:
+                contents = cache_file.read()
+            if not contents.startswith(self.format_header):
+                return None  # written by another version of fragments, it will be replaced
+            weave = Weave.from_dict(json.loads(zlib.decompress(contents[len(self.format_header):]).decode('utf8')))
+            os.utime(path, None)
+        except (EnvironmentError, ValueError, KeyError, TypeError, zlib.error):
+            return None  # missing or corrupt, rebuild it
+        return weave
+
+    def _dump(self, name, weave):
+        path = os.path.join(self.directory, name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(path + '.tmp', 'wb') as cache_file:
+                cache_file.write(self.format_header + zlib.compress(json.dumps(weave.to_dict()).encode('utf8')))
+            os.rename(path + '.tmp', path)
+            names = [n for n in os.listdir(self.directory) if not n.startswith(self.outcomes_file_name)]
+            names.sort(key=lambda n: os.stat(os.path.join(self.directory, n)).st_mtime_ns)
+            for stale_name in names[:-self.size]:
+                os.unlink(os.path.join(self.directory, stale_name))
+        except EnvironmentError:
+            pass  # the cache only saves time, apply works without it
+
+
+_anchor_context = 3  # number of unchanged lines on each side of a change that can tie it to a place in another file
+_worker_weaves = None  # [(source weave, its anchor lines)], in processes started by apply --jobs
+
+
+def _anchor_lines(diff, selected, old_lines):
     """
-    parser = argparse.ArgumentParser(prog="%s %s" % (__package__, apply.__name__), description=apply.__doc__)
-    parser.add_argument('SOURCE_FILENAME', help="file containing changes to be applied")
-    parser.add_argument('TARGET_FILENAME', help="file(s) to apply changes to", nargs='*', default=['.'])
-    parser.add_argument('-U', '--unified', type=int, dest="NUM", default=3, action="store", help="number of lines of context to show")
-    group = parser.add_mutually_exclusive_group()
-    group.add_argument("-i", "--interactive", action="store_true" , default=True , dest="interactive", help="interactively select changes to apply")
-    group.add_argument("-a", "--automatic"  , action="store_false", default=False, dest="interactive", help="automatically apply all changes")
-    args = parser.parse_args(args)
+    Returns the lines a file has to share with a source for the selected changes to apply to it, given the source's diff,
+    the indexes of the selected changes in it, and its committed lines: the lines the changes remove or add and the unchanged lines around them.
+    Lines that appear more than once in the source, or have no letters or digits, such as blank lines and braces, are left out,
+    as they can't tie the changes to one place in another file.
+    """
+    counts = collections.Counter(old_lines)
+    anchors = set()
+    for i in selected:
+        anchors.update(diff[i][0])
+        anchors.update(diff[i][1])
+        for line_or_conflict in diff[max(0, i - _anchor_context):i] + diff[i + 1:i + 1 + _anchor_context]:
+            if not isinstance(line_or_conflict, tuple):
+                anchors.add(line_or_conflict)
+    return set(line for line in anchors if counts[line] <= 1 and any(c.isalnum() for c in line))
 
-    config = FragmentsConfig()
-    weave = Weave()
-    changed_path = os.path.realpath(args.SOURCE_FILENAME)
-    changed_key = os.path.relpath(changed_path, config.root)
-    if changed_key not in config['files']:
-        yield "Could not apply changes in '%s', it is not being followed" % os.path.relpath(changed_path)
-        return
-    elif not os.access(changed_path, os.R_OK|os.W_OK):
-        yield "Could not apply changes in '%s', it no longer exists on disk" % os.path.relpath(changed_path)
-        return
 
-    old_path = os.path.join(config.directory, config['files'][changed_key])
+def _init_worker(weaves):
+    global _worker_weaves
+    _worker_weaves = weaves
 
-    if not os.access(old_path, os.R_OK|os.W_OK):
-        yield "Could not apply changes in '%s', it has never been committed" % os.path.relpath(changed_path)
-        return
 
+def _merge_into(item, weaves=None):
+    """
+    Returns the result of cherry picking the selected changes (revision 3 of the weave for source) into the file at other_path, given as item = (source, other_path).
+    Returns None without merging if the file has none of the source's anchor lines, as the changes can not apply to it.
+    """
+    source, other_path = item
+    weave, anchors = (_worker_weaves if weaves is None else weaves)[source]
+    with _smart_open(other_path, 'r') as other_file:
+        other_lines = other_file.readlines()
+    if other_lines and anchors and anchors.isdisjoint(other_lines):  # an empty file has nothing to share, but changes to an empty source can apply to it
+        return None
+    other_weave = weave.copy()  # each target is matched against the source revisions only, not against the targets before it
+    other_weave.add_revision(4, other_lines, [])
+    return other_weave.cherry_pick(3, 4)  # Can I apply changes in revision 3 onto this other file?
+
+
+def _merged_lines(merge_result):
+    """Returns the lines of a merge result, with conflict sections"""
+    lines = []
+    for line_or_conflict in merge_result:
+        if isinstance(line_or_conflict, tuple):
+            lines.append('>'*7 + '\n')
+            lines.extend(line_or_conflict[0])
+            lines.append('='*7 + '\n')
+            lines.extend(line_or_conflict[1])
+            lines.append('>'*7 + '\n')
+        else:
+            lines.append(line_or_conflict)
+    return lines
+
+
+def _select_changes(config, cache, changed_path, args):
+    """
+    Shows the changes in changed_path since it was committed, and lets the user select those to apply, unless args.interactive is False.
+    Yields diff lines and prompts, and returns the weave and weave name with the selected changes as revision 3, and the changes' anchor lines,
+    or None if none were selected.
+    """
+    changed_key = os.path.relpath(changed_path, config.root)
     old_revision = 1
-    with _smart_open(old_path, 'r') as old_file:
-        weave.add_revision(old_revision, old_file.readlines(), [])
     new_revision = 2
     with _smart_open(changed_path, 'r') as new_file:
-        weave.add_revision(new_revision, new_file.readlines(), [])
+        new_lines = new_file.readlines()
+    old_lines = _snapshot_lines(config, changed_key)
+    weave, weave_name = cache.add_revisions(Weave(), None, [(old_revision, old_lines, []), (new_revision, new_lines, [])])
 
     diff = weave.merge(old_revision, new_revision)
 
@@ -112,10 +241,11 @@ def apply(*args):
 
     if not preserve_changes:
         yield "No changes in '%s' to apply." % os.path.relpath(changed_path)
-        return
+        return None
 
     # Build the changed file to be applied
     changes_to_apply = []
+    selected = []  # indexes of the selected changes in diff
 
     i = 0
     old_line = 0
@@ -126,6 +256,7 @@ def apply(*args):
             old, new = line_or_conflict
             if (old_line, new_line) in preserve_changes:
                 changes_to_apply.extend(new)
+                selected.append(i)
             elif (old_line, new_line) in discard_changes:
                 changes_to_apply.extend(old)
             else:  # pragma: no cover
@@ -139,37 +270,200 @@ def apply(*args):
             i += 1
             changes_to_apply.append(line_or_conflict)
 
+    changed_revision = 3
+    weave, weave_name = cache.add_revisions(weave, weave_name, [(changed_revision, changes_to_apply, [old_revision])])
+    return weave, weave_name, _anchor_lines(diff, selected, old_lines)
+
+
+def apply(*args):
+    """
+    Apply changes in SOURCE_FILENAME that were made since last commit, where possible.
+    Limit application to TARGET_FILENAME(s) if specified.
+    Files that conflict in their entirety will be skipped,
+    as will files that have none of the lines changed or around the changes, not counting lines with no letters or digits or that appear more than once in SOURCE_FILENAME.
+    Smaller conflicts will be written to the file as conflict sections.
+    With --all-modified, apply the changes in every modified file among the TARGET_FILENAME(s) to the others, in one pass;
+    when changes from more than one file apply to the same file, changes that overlap those applied before them are skipped.
+    Modified files get each other's changes too, except changes that overlap their own.
+
+    In interactive mode, you can use the following commands:
+
+        y - include this change
+        n - do not include this change
+        a - include this change and all remaining changes
+        d - done, do not include this change nor any remaining changes
+        j - leave this change undecided, see next undecided change
+        k - leave this change undecided, see previous undecided change
+        ? - interactive apply mode help
+    """
+    parser = argparse.ArgumentParser(prog="%s %s" % (__package__, apply.__name__), description=apply.__doc__)
+    parser.add_argument('SOURCE_FILENAME', help="file containing changes to be applied, unless --all-modified is used", nargs='?')
+    parser.add_argument('TARGET_FILENAME', help="file(s) to apply changes to", nargs='*')
+    parser.add_argument('-U', '--unified', type=int, dest="NUM", default=3, action="store", help="number of lines of context to show")
+    parser.add_argument('-j', '--jobs', type=int, dest="JOBS", default=1, action="store", help="number of files to merge changes into at once, in separate processes")
+    parser.add_argument('-m', '--all-modified', action="store_true", dest="all_modified", default=False, help="apply changes in all modified files")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-i", "--interactive", action="store_true" , default=True , dest="interactive", help="interactively select changes to apply")
+    group.add_argument("-a", "--automatic"  , action="store_false", default=False, dest="interactive", help="automatically apply all changes")
+    args = parser.parse_args(args)
+
+    config = FragmentsConfig()
+    target_filenames = args.TARGET_FILENAME or ['.']
+    if args.all_modified:
+        if args.SOURCE_FILENAME is not None:  # all file names are targets
+            target_filenames = [args.SOURCE_FILENAME] + args.TARGET_FILENAME
+        changed_paths = [changed_path for s, changed_path in _iterate_over_files(target_filenames, config, statuses='M') if s == 'M']
+        if not changed_paths:
+            yield "Could not apply changes, no files have been modified"
+            return
+    else:
+        if args.SOURCE_FILENAME is None:
+            parser.error("the following arguments are required: SOURCE_FILENAME")
+        changed_path = os.path.realpath(args.SOURCE_FILENAME)
+        changed_key = os.path.relpath(changed_path, config.root)
+        if changed_key not in config['files']:
+            yield "Could not apply changes in '%s', it is not being followed" % os.path.relpath(changed_path)
+            return
+        elif not os.access(changed_path, os.R_OK|os.W_OK):
+            yield "Could not apply changes in '%s', it no longer exists on disk" % os.path.relpath(changed_path)
+            return
+
+        if _snapshot_signature(config, changed_key) is None:
+            yield "Could not apply changes in '%s', it has never been committed" % os.path.relpath(changed_path)
+            return
+        changed_paths = [changed_path]
+
+    cache = WeaveCache(config)
+    sources = []  # [(changed path, weave, weave name)]
+    source_anchors = []  # for each source, the anchor lines of its selected changes; if it has none, any file may be related
+    for changed_path in changed_paths:
+        selected = yield from _select_changes(config, cache, changed_path, args)
+        if selected is not None:
+            weave, weave_name, anchor_lines = selected
+            sources.append((changed_path, weave, weave_name))
+            source_anchors.append(anchor_lines)
+    if not sources:
+        return
+
     # Apply the changes across other files
-    current_revision = changed_revision = 3
-    weave.add_revision(changed_revision, changes_to_apply, [1])
-
-    for s, other_path in _iterate_over_files(args.TARGET_FILENAME, config, statuses='MAD '):
-        if other_path == changed_path:
-            continue  # don't try to apply changes to ourself
-        current_revision += 1
-        with _smart_open(other_path, 'r') as other_file:
-            weave.add_revision(current_revision, other_file.readlines(), [])
-        merge_result = weave.cherry_pick(changed_revision, current_revision)  # Can I apply changes in changed_revision onto this other file?
-        if len(merge_result) == 1 and isinstance(merge_result[0], tuple):
-            # total conflict, skip
-            yield "Changes in '%s' cannot apply to '%s', skipping" % (os.path.relpath(changed_path), os.path.relpath(other_path))
-        elif tuple in set(type(mr) for mr in merge_result):
-            # some conflicts exist
-            with _smart_open(other_path, 'w') as other_file:
-                for line_or_conflict in merge_result:
-                    if isinstance(line_or_conflict, tuple):
-                        other_file.write('>'*7 + '\n')
-                        for line in line_or_conflict[0]:
-                            other_file.write(line)
-                        other_file.write('='*7 + '\n')
-                        for line in line_or_conflict[1]:
-                            other_file.write(line)
-                        other_file.write('>'*7 + '\n')
-                    else:
-                        other_file.write(line_or_conflict)
-            yield "Conflict merging '%s' into '%s'" % (os.path.relpath(changed_path), os.path.relpath(other_path))
+    config.lines.load()
+    targets = [(s, other_path) for s, other_path in _iterate_over_files(target_filenames, config, statuses='MAD ') if args.all_modified or other_path not in changed_paths]
+    indexed_keys = set()  # targets unchanged since they were committed, so the line index knows what is in them
+    for s, other_path in targets:
+        if s == ' ':
+            other_key = os.path.relpath(other_path, config.root)
+            _refresh_lines(config, other_key)
+            if config.lines.has_lines(other_key):  # an empty file shares no lines, but changes to an empty source can apply to it
+                indexed_keys.add(other_key)
+    config.lines.dump()
+    related_keys = []  # for each source, followed files whose committed versions share an anchor line with it
+    for anchor_lines in source_anchors:
+        related_keys.append(set())
+        for line_digest in set(_line_digest(line) for line in anchor_lines):
+            related_keys[-1].update(config.lines.files_with_line(line_digest))
+    other_paths = []
+    other_digests = []
+    unrelated = []  # for each target, the sources it is known to have nothing in common with, and the source it is itself
+    for s, other_path in targets:
+        other_key = os.path.relpath(other_path, config.root)
+        other_paths.append(other_path)
+        if other_key in indexed_keys:
+            unrelated.append(set(source for source in range(len(sources)) if source_anchors[source] and other_key not in related_keys[source]))
         else:
-            # Merge is clean:
-            with _smart_open(other_path, 'w') as other_file:
-                other_file.writelines(merge_result)
-            yield "Changes in '%s' applied cleanly to '%s'" % (os.path.relpath(changed_path), os.path.relpath(other_path))
+            unrelated.append(set())
+        unrelated[-1].update(source for source, (changed_path, weave, weave_name) in enumerate(sources) if changed_path == other_path)  # don't try to apply changes to ourselves
+        if len(unrelated[-1]) == len(sources):
+            other_digests.append(None)  # nothing in common with any source, no need to read it
+        else:
+            other_digests.append(_file_digest(other_path))
+
+    outcomes = {}  # {(source, target digest): outcome} recorded by earlier runs, no need to merge those again
+    pending = []  # (source, path) of the first file with each digest, identical files are merged once
+    for other_path, other_digest, other_unrelated in zip(other_paths, other_digests, unrelated):
+        for source, (changed_path, weave, weave_name) in enumerate(sources):
+            if source in other_unrelated or (source, other_digest) in outcomes:
+                continue
+            outcomes[(source, other_digest)] = cache.outcome(weave_name, other_digest)
+            if outcomes[(source, other_digest)] is None:
+                pending.append((source, other_path))
+    executor = None
+    weaves = [(weave, anchor_lines) for (changed_path, weave, weave_name), anchor_lines in zip(sources, source_anchors)]
+    if args.JOBS > 1 and pending:
+        executor = ProcessPoolExecutor(max_workers=args.JOBS, initializer=_init_worker, initargs=(weaves,))  # the weaves are sent to each process once
+    merge_function = _merge_into if executor else functools.partial(_merge_into, weaves=weaves)
+    merge_results = _ordered_map(merge_function, pending, jobs=args.JOBS, executor=executor)
+
+    try:
+        merge_results_by_digest = {}
+        for other_path, other_digest, other_unrelated in zip(other_paths, other_digests, unrelated):
+            applied = []  # [(source, outcome, lines)] for the changes that apply to this file
+            for source, (changed_path, weave, weave_name) in enumerate(sources):
+                if changed_path == other_path:
+                    continue  # a modified file is a target of the other modified files' changes, not of its own
+                outcome = 'skip' if source in other_unrelated else outcomes[(source, other_digest)]
+                if outcome is None:
+                    if (source, other_digest) not in merge_results_by_digest:
+                        merge_results_by_digest[(source, other_digest)] = next(merge_results)
+                    merge_result = merge_results_by_digest[(source, other_digest)]
+                    if merge_result is None or (len(merge_result) == 1 and isinstance(merge_result[0], tuple)):
+                        outcome = 'skip'
+                    elif tuple in set(type(mr) for mr in merge_result):
+                        outcome = 'conflict'
+                    elif _digest(''.join(merge_result).encode('utf8')).hexdigest() == other_digest:
+                        outcome = 'unchanged'
+                    else:
+                        outcome = 'clean'
+                    if outcome in ('skip', 'unchanged') and other_digest is not None:
+                        cache.record(weave_name, other_digest, outcome)
+
+                if outcome == 'skip':
+                    # total conflict, skip
+                    yield "Changes in '%s' cannot apply to '%s', skipping" % (os.path.relpath(changed_path), os.path.relpath(other_path))
+                elif outcome == 'conflict' and other_path in changed_paths:
+                    # conflicts with the target's own changes, which are not overwritten with conflict sections
+                    yield "Changes in '%s' overlap with other changes to '%s', skipping" % (os.path.relpath(changed_path), os.path.relpath(other_path))
+                else:
+                    applied.append((source, outcome, _merged_lines(merge_result) if outcome in ('clean', 'conflict') else None))
+            if not applied:
+                continue
+
+            if len(applied) == 1:
+                merged_lines = applied[0][2]
+            else:
+                # Changes from more than one file, combine them as revisions based on this file
+                with _smart_open(other_path, 'r') as other_file:
+                    other_lines = other_file.readlines()
+                combining = Weave()
+                combining.add_revision(0, other_lines, [])
+                combined_revision = merged_lines = None
+                next_combined_revision = -1
+                remaining, applied = applied, []
+                for source, outcome, source_lines in remaining:
+                    source_revision = source + 1
+                    combining.add_revision(source_revision, other_lines if source_lines is None else source_lines, [0])
+                    if combined_revision is None:
+                        combined_revision, merged_lines = source_revision, source_lines
+                    else:
+                        combined_lines = combining.merge(combined_revision, source_revision)
+                        if tuple in set(type(cl) for cl in combined_lines):
+                            yield "Changes in '%s' overlap with other changes to '%s', skipping" % (os.path.relpath(sources[source][0]), os.path.relpath(other_path))
+                            continue
+                        combining.add_revision(next_combined_revision, combined_lines, [combined_revision, source_revision])
+                        combined_revision, merged_lines = next_combined_revision, combined_lines
+                        next_combined_revision -= 1
+                    applied.append((source, outcome, source_lines))
+
+            if merged_lines is not None:  # otherwise the file already has the changes
+                with _smart_open(other_path, 'w') as other_file:
+                    other_file.writelines(merged_lines)
+            for source, source_outcome, source_lines in applied:
+                changed_path = sources[source][0]
+                if source_outcome == 'conflict':
+                    yield "Conflict merging '%s' into '%s'" % (os.path.relpath(changed_path), os.path.relpath(other_path))
+                else:
+                    yield "Changes in '%s' applied cleanly to '%s'" % (os.path.relpath(changed_path), os.path.relpath(other_path))
+    finally:
+        merge_results.close()  # otherwise the worker processes are only shut down when it is garbage collected
+        if executor is not None:
+            executor.shutdown()
+    cache.dump_outcomes()
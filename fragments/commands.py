@@ -7,10 +7,13 @@ import hashlib
 import argparse
 #import difflib
 
-from . import __version__, FragmentsError, _iterate_over_files, _smart_open
-from .config import FragmentsConfig, configuration_directory_name, ConfigurationFileCorrupt, ConfigurationFileNotFound, ConfigurationDirectoryNotFound
+from . import __version__, FragmentsError, _iterate_over_files, _smart_open, _update_index, _digest, _compressors
+from . import _snapshot_path, _snapshot_signature, _snapshot_lines, _read_snapshot, _write_snapshot, _remove_snapshots, _refresh_lines
+from .config import FragmentsConfig, _line_digest, configuration_file_name, configuration_directory_name, ConfigurationFileCorrupt, ConfigurationFileNotFound, ConfigurationDirectoryNotFound
 from .diff import _full_diff
 from .apply import apply
+from .watch import watch
+from .serve import serve, _connect, _remote, _local_commands
 from .precisecodevillemerge import Weave
 from . import color
 
@@ -35,17 +38,25 @@ def init(*args):
     """Initialize a new fragments repository. Repository is in a directory named _fragments/, created in either the current working directory, or FRAGMENTS_ROOT if specified."""
     parser = argparse.ArgumentParser(prog="%s %s" % (__package__, init.__name__), description=init.__doc__)
     parser.add_argument('FRAGMENTS_ROOT', help="root directory in which to create the _fragments/ directory", nargs="?")
+    parser.add_argument('-b', '--backend', choices=FragmentsConfig.backends, dest="BACKEND", default=None, action="store", help="store the configuration in config.json (the default) or in an sqlite database")
+    parser.add_argument('-s', '--storage', choices=FragmentsConfig.storages, dest="STORAGE", default='flat', action="store", help="store committed files by file name (the default) or by contents, sharing identical files")
+    parser.add_argument('-c', '--compression', choices=sorted(_compressors), dest="COMPRESSION", default=None, action="store", help="compress committed files")
     args = parser.parse_args(args)
 
+    def _create(config):
+        config['storage'] = args.STORAGE
+        config['compression'] = args.COMPRESSION
+        config.dump()
+
     try:
         config = FragmentsConfig()
     except ConfigurationFileCorrupt:
         config = FragmentsConfig(autoload=False)
         os.rename(config.path, config.path + '.corrupt')
-        config.dump()
+        _create(config)
     except ConfigurationFileNotFound:
-        config = FragmentsConfig(autoload=False)
-        config.dump()
+        config = FragmentsConfig(autoload=False, backend=args.BACKEND)
+        _create(config)
     except ConfigurationDirectoryNotFound:
         if args.FRAGMENTS_ROOT:
             configuration_parent = os.path.realpath(args.FRAGMENTS_ROOT)
@@ -54,8 +65,8 @@ def init(*args):
         if os.access(configuration_parent, os.R_OK|os.W_OK):
             configuration_path = os.path.join(configuration_parent, configuration_directory_name)
             os.mkdir(configuration_path)
-            config = FragmentsConfig(configuration_path, autoload=False)
-            config.dump()
+            config = FragmentsConfig(configuration_path, autoload=False, backend=args.BACKEND)
+            _create(config)
         else:
             raise ExecutionError("Could not create fragments directory in '%s', aborting.\n(Do you have the correct permissions?)" % configuration_parent)
     else:
@@ -63,6 +74,18 @@ def init(*args):
     yield "Fragments configuration created in '%s'" % config.path
 
 
+def export(*args):
+    """Export the fragments configuration in the config.json format to FILENAME, or to config.json in the _fragments/ directory if not specified."""
+    parser = argparse.ArgumentParser(prog="%s %s" % (__package__, export.__name__), description=export.__doc__)
+    parser.add_argument('FILENAME', help="file to export the configuration to", nargs="?")
+    args = parser.parse_args(args)
+
+    config = FragmentsConfig()
+    path = os.path.realpath(args.FILENAME) if args.FILENAME else os.path.join(config.directory, configuration_file_name)
+    config.export(path)
+    yield "Fragments configuration exported to '%s'" % path
+
+
 def _file_key(file_path):
     """Converts a file path into a key for storing the file's committed contents in the _fragments/ directory."""
     return hashlib.sha256(('%s:%s' % (__package__, file_path)).encode('utf8')).hexdigest()
@@ -85,13 +108,16 @@ def status(*args):
     parser = argparse.ArgumentParser(prog="%s %s" % (__package__, status.__name__), description=status.__doc__)
     parser.add_argument('FILENAME', help="files to show status for", nargs="*", default=['.'])
     parser.add_argument('-l', '--limit', type=str, dest="STATUS", default='MDAE ', action="store", help="limit to files in STATUS")
+    parser.add_argument('-j', '--jobs', type=int, dest="JOBS", default=1, action="store", help="number of files to check at once")
+    parser.add_argument('-s', '--stream', action="store_true", dest="STREAM", default=False, help="show each file as soon as it is checked, in filename order")
     args = parser.parse_args(args)
 
     config = FragmentsConfig()
     yield "%s configuration version %s.%s.%s" % ((__package__,) + config['version'])
     yield "stored in %s" % config.directory
-    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses=args.STATUS):
+    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses=args.STATUS, jobs=args.JOBS, stream=args.STREAM):
         yield _status_to_color.get(s, str)('%s\t%s' % (s, os.path.relpath(curr_path)))
+    config.index.dump()
 
 
 def follow(*args):
@@ -109,6 +135,11 @@ def follow(*args):
                 yield "'%s' is already being followed" % os.path.relpath(filename)
                 continue
             if os.access(fullpath, os.W_OK|os.R_OK):
+                config.index.discard(key)  # never trust stat data left over from an earlier file with this name
+                if config.get('storage', 'flat') != 'flat':
+                    config['files'][key] = ''  # named after its contents once committed
+                    yield "'%s' is now being followed" % os.path.relpath(filename)
+                    continue
                 file_sha = _file_key(key)
                 config['files'][key] = file_sha
                 yield "'%s' is now being followed (SHA-256: '%s')" % (os.path.relpath(filename), file_sha)
@@ -123,26 +154,29 @@ def forget(*args):
     """Stop following changes to one or more FILENAME(s)."""
     parser = argparse.ArgumentParser(prog="%s %s" % (__package__, forget.__name__), description=forget.__doc__)
     parser.add_argument('FILENAME', help="files to forget", nargs="+")
+    parser.add_argument('-j', '--jobs', type=int, dest="JOBS", default=1, action="store", help="number of files to check at once")
     args = parser.parse_args(args)
 
     config = FragmentsConfig()
-    for s, filename in _iterate_over_files(args.FILENAME, config, statuses='MDAE '):
+    forgotten = []
+    for s, filename in _iterate_over_files(args.FILENAME, config, statuses='MDAE ', jobs=args.JOBS):
         fullpath = os.path.realpath(filename)
         if fullpath.startswith(config.root):
             key = os.path.relpath(fullpath, config.root)
             if key in config['files']:
-                file_sha = config['files'][key]
-                sha_path = os.path.join(config.directory, file_sha)
-                if os.access(os.path.join(config.directory, file_sha), os.W_OK|os.R_OK):
-                    os.unlink(sha_path)
+                if _snapshot_signature(config, key) is not None:
+                    forgotten.append((key, config['files'][key]))
                     yield "'%s' is no longer being followed" % os.path.relpath(filename)
                 else:
                     yield "'%s' was never committed and will not be followed" % os.path.relpath(filename)
                 del config['files'][key]
+                config.index.discard(key)
+                config.lines.discard(key)
             else:
                 yield "Could not forget '%s', it was not being followed" % os.path.relpath(filename)
         else:
             yield "Could not forget '%s'; it is outside the repository" % os.path.relpath(filename)
+    _remove_snapshots(config, forgotten)
     config.dump()
 
 
@@ -173,10 +207,20 @@ def rename(*args):
         elif not os.access(old_path, os.W_OK|os.R_OK) and not os.access(new_path, os.W_OK|os.R_OK):
             yield "Could not rename '%s' to '%s', neither file exists" % (old_name, new_name)
         else:
-            new_sha = _file_key(new_key)
-            os.rename(os.path.join(config.directory, config['files'][old_key]), os.path.join(config.directory, new_sha))
-            config['files'][new_key] = new_sha
-            del config['files'][old_key]
+            value = config['files'][old_key]
+            if config.get('storage', 'flat') == 'flat':
+                config['files'][new_key] = _file_key(new_key)
+                os.rename(_snapshot_path(config, old_key), _snapshot_path(config, new_key))
+                del config['files'][old_key]
+            else:  # committed versions are named after their contents, so stay where they are,
+                if value and config['storage'] == 'weave' and os.path.dirname(old_key) != os.path.dirname(new_key):
+                    _write_snapshot(config, new_key, _read_snapshot(config, old_key), None, value)  # unless they move to another directory's weave
+                else:
+                    config['files'][new_key] = value
+                del config['files'][old_key]
+                _remove_snapshots(config, [(old_key, value)])
+            config.index.discard(old_key)
+            config.lines.rename(old_key, new_key)
             if os.access(old_path, os.W_OK|os.R_OK):
                 os.rename(old_path, new_path)
 
@@ -221,11 +265,12 @@ def diff(*args):
     parser = argparse.ArgumentParser(prog="%s %s" % (__package__, diff.__name__), description=diff.__doc__)
     parser.add_argument('FILENAME', help="file(s) to show changes in", nargs="*", default=['.'])
     parser.add_argument('-U', '--unified', type=int, dest="NUM", default=3, action="store", help="number of lines of context to show")
+    parser.add_argument('-j', '--jobs', type=int, dest="JOBS", default=1, action="store", help="number of files to check at once")
     args = parser.parse_args(args)
 
     config = FragmentsConfig()
 
-    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses='MAD'):
+    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses='MAD', jobs=args.JOBS):
         key = os.path.relpath(curr_path, config.root)
         if key not in config['files']:
             yield "Could not diff '%s', it is not being followed" % os.path.relpath(curr_path)
@@ -238,9 +283,7 @@ def diff(*args):
                 with _smart_open(curr_path, 'r') as curr_file:
                     curr_lines = curr_file.readlines()
             if s in 'MD':
-                repo_path = os.path.join(config.directory, config['files'][key])
-                with _smart_open(repo_path, 'r') as repo_file:
-                    repo_lines = repo_file.readlines()
+                repo_lines = _snapshot_lines(config, key)
             weave = Weave()
             weave.add_revision(1, repo_lines, [])
             weave.add_revision(2, curr_lines, [])
@@ -248,60 +291,76 @@ def diff(*args):
                 yield l
             # for dl in difflib.unified_diff(repo_lines, curr_lines, fromfile=key, tofile=key):
             #     yield dl
+    config.index.dump()
 
 
 def commit(*args):
     """Commit changes to the fragments repository, limited to FILENAME(s) if specified."""
     parser = argparse.ArgumentParser(prog="%s %s" % (__package__, commit.__name__), description=commit.__doc__)
     parser.add_argument('FILENAME', help="file(s) to commit", nargs="*", default=['.'])
+    parser.add_argument('-j', '--jobs', type=int, dest="JOBS", default=1, action="store", help="number of files to check at once")
     args = parser.parse_args(args)
 
     config = FragmentsConfig()
-
-    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses='MAD'):
+    replaced = []
+    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses='MAD', jobs=args.JOBS):
         key = os.path.relpath(curr_path, config.root)
         if key not in config['files']:
             yield "Could not commit '%s' because it is not being followed" % os.path.relpath(curr_path)
             continue
 
         if s in 'MA':
-            repo_path = os.path.join(config.directory, config['files'][key])
-            with _smart_open(repo_path, 'w') as repo_file:
-                with _smart_open(curr_path, 'r') as curr_file:
-                    repo_file.write(curr_file.read())
-            os.utime(repo_path, os.stat(curr_path)[7:9])
+            with _smart_open(curr_path, 'r') as curr_file:
+                contents = curr_file.read().encode('utf8')
+            curr_stat = os.stat(curr_path)
+            digest = _digest(contents).hexdigest()
+            old_value = config['files'][key]
+            _write_snapshot(config, key, contents, curr_stat, digest)
+            if config['files'][key] != old_value:
+                replaced.append((key, old_value))
+            _update_index(config, key, _snapshot_signature(config, key), curr_stat, digest)
             yield "'%s' committed" % os.path.relpath(curr_path)
         elif s == 'D':
             yield "Could not commit '%s' because it has been removed, instead revert or forget it" % os.path.relpath(curr_path)
         elif s == ' ':
             yield "Could not commit '%s' because it has not been changed" % os.path.relpath(curr_path)
+    if config.get('storage', 'flat') == 'flat':
+        config.index.dump()
+        config.lines.dump()
+    else:
+        _remove_snapshots(config, replaced)
+        config.dump()  # followed files now refer to different objects or revisions
 
 
 def revert(*args):
     """Revert changes to the fragments repository, limited to FILENAME(s) if specified."""
     parser = argparse.ArgumentParser(prog="%s %s" % (__package__, revert.__name__), description=revert.__doc__)
     parser.add_argument('FILENAME', help="file(s) to revert", nargs="*", default=['.'])
+    parser.add_argument('-j', '--jobs', type=int, dest="JOBS", default=1, action="store", help="number of files to check at once")
     args = parser.parse_args(args)
 
     config = FragmentsConfig()
 
-    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses='MAD'):
+    for s, curr_path in _iterate_over_files(args.FILENAME, config, statuses='MAD', jobs=args.JOBS):
         key = os.path.relpath(curr_path, config.root)
         if key not in config['files']:
             yield "Could not revert '%s' because it is not being followed" % os.path.relpath(curr_path)
             continue
 
         if s in 'MD':
-            repo_path = os.path.join(config.directory,  config['files'][key])
-            with _smart_open(curr_path, 'w') as curr_file:
-                with _smart_open(repo_path, 'r') as repo_file:
-                    curr_file.write(repo_file.read())
-            os.utime(curr_path, os.stat(repo_path)[7:9])
+            contents = _read_snapshot(config, key)
+            with open(curr_path, 'wb') as curr_file:
+                curr_file.write(contents)
+            repo_path = _snapshot_path(config, key)
+            if repo_path is not None:
+                os.utime(curr_path, os.stat(repo_path)[7:9])
+            _update_index(config, key, _snapshot_signature(config, key), os.stat(curr_path), _digest(contents).hexdigest())
             yield "'%s' reverted" % key
         elif s == 'A':
             yield "Could not revert '%s' because it has never been committed" % os.path.relpath(curr_path)
         elif s == ' ':
             yield "Could not revert '%s' because it has not been changed" % os.path.relpath(curr_path)
+    config.index.dump()
 
 
 def fork(*args):
@@ -374,13 +433,49 @@ def fork(*args):
     yield "Forked new file in '%s', remember to follow and commit it" % os.path.relpath(args.TARGET_FILENAME)
     config.dump()
 
-move = rename
+def search(*args):
+    """
+    Search followed files for the lines in BLOCK_FILENAME, limited to FILENAME(s) if specified.
+    Shows each file containing all of those lines in a row, with the line number where they start.
+    """
+    parser = argparse.ArgumentParser(prog="%s %s" % (__package__, search.__name__), description=search.__doc__)
+    parser.add_argument('BLOCK_FILENAME', help="file containing the lines to search for")
+    parser.add_argument('FILENAME', help="files to search", nargs="*", default=['.'])
+    args = parser.parse_args(args)
 
+    config = FragmentsConfig()
+    block_path = os.path.realpath(args.BLOCK_FILENAME)
+    if not os.access(block_path, os.R_OK):
+        yield "Could not search for '%s', it does not exist" % os.path.relpath(block_path)
+        return
+    with _smart_open(block_path, 'r') as block_file:
+        block = [line.rstrip('\r\n') for line in block_file.readlines()]
+    if not block:
+        yield "Nothing to search for, '%s' is empty" % os.path.relpath(block_path)
+        return
+
+    files = list(_iterate_over_files(args.FILENAME, config, statuses='MA '))
+    for s, curr_path in files:
+        if s == ' ':  # unchanged since it was committed, so the line index can tell what is in it
+            _refresh_lines(config, os.path.relpath(curr_path, config.root))
+    config.lines.dump()
+    candidate_keys = None  # followed files whose committed versions contain every line of the block
+    for line_digest in set(_line_digest(line) for line in block):
+        keys = config.lines.files_with_line(line_digest)
+        candidate_keys = keys if candidate_keys is None else candidate_keys & keys
+    for s, curr_path in files:
+        key = os.path.relpath(curr_path, config.root)
+        if curr_path == block_path or (s == ' ' and key not in candidate_keys):
+            continue  # unchanged since it was committed without some of the lines, no need to read it
+        with _smart_open(curr_path, 'r') as curr_file:
+            lines = [line.rstrip('\r\n') for line in curr_file.readlines()]
+        for i in range(len(lines) - len(block) + 1):
+            if lines[i:i+len(block)] == block:
+                yield "%s:%d" % (os.path.relpath(curr_path), i + 1)
+    config.index.dump()
 
-try:
-    raw_input
-except NameError:  # pragma: no cover # Python 3 support
-    raw_input = input
+
+move = rename
 
 
 def _colorize(line):  # pragma: no cover
@@ -409,12 +504,16 @@ def _main():  # pragma: no cover
                     print(' '.join(__all__))
     if (cmd):  # command is present and legit
         try:
-            command_generator = getattr(commands, cmd)(*sys.argv[2:])
+            connection = _connect() if cmd not in _local_commands else None
+            if connection is not None:
+                command_generator = _remote(connection, cmd, *sys.argv[2:])
+            else:
+                command_generator = getattr(commands, cmd)(*sys.argv[2:])
             while True:
                 try:
                     l = next(command_generator)
                     if isinstance(l, color.Prompt):
-                        response = raw_input(_colorize(l))
+                        response = input(_colorize(l))
                         l = command_generator.send(response.strip())
                     print(_colorize(l))
                 except StopIteration:
@@ -424,4 +523,4 @@ def _main():  # pragma: no cover
         except KeyboardInterrupt:
             pass
 
-__all__ = ['help', 'init', 'status', 'follow', 'forget', 'rename', 'move', 'diff', 'commit', 'revert', 'fork', 'apply']
+__all__ = ['help', 'init', 'status', 'follow', 'forget', 'rename', 'move', 'diff', 'commit', 'revert', 'fork', 'apply', 'watch', 'serve', 'export', 'search']
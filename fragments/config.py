@@ -2,12 +2,22 @@
 from __future__ import unicode_literals
 
 import os
+import re
 import json
+import time
+import sqlite3
+import threading
+from collections.abc import MutableMapping
 
-from . import FragmentsError, __version__
+from . import FragmentsError, __version__, _stat_signature, _racy_window, _compress, _decompress, _digest
+from .precisecodevillemerge import Weave
 
 
 configuration_file_name = 'config.json'
+sqlite_configuration_file_name = 'config.sqlite'
+index_file_name = 'index.json'
+lines_file_name = 'lines.sqlite'
+ignore_file_name = '.fragmentsignore'
 configuration_directory_name = '_fragments'
 
 
@@ -23,6 +33,32 @@ class ConfigurationFileNotFound(ConfigurationError): pass
 class ConfigurationFileCorrupt(ConfigurationError): pass
 
 
+_json_cache = None  # {path: (stat signature, parsed contents)}; only long-running processes turn this on, see _cache_json_files()
+
+
+def _cache_json_files(enabled=True):
+    """Keep parsed config.json and index.json files in memory, reparsing them only when they change on disk"""
+    global _json_cache
+    _json_cache = {} if enabled else None
+
+
+def _read_json(path):
+    if _json_cache is None:
+        with open(path, 'r') as json_file:
+            return json.loads(json_file.read())
+    signature = _stat_signature(os.stat(path))
+    cached = _json_cache.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, 'r') as json_file:
+            parsed = json.loads(json_file.read())
+        if signature[1] < time.time() * 10**9 - _racy_window:  # otherwise a change within the same mtime tick would go unnoticed
+            _json_cache[path] = (signature, parsed)
+        cached = (signature, parsed)
+    if not isinstance(cached[1], dict):
+        return cached[1]
+    return dict((k, dict(v) if isinstance(v, dict) else v) for k, v in cached[1].items())  # callers modify what they load
+
+
 def find_configuration(current=None):
     current = current or os.getcwd()
     path = current
@@ -36,36 +72,402 @@ def find_configuration(current=None):
 
 
 class FragmentsConfig(dict):
+    """
+    Repository configuration, stored either as config.json or, with the sqlite backend, as config.sqlite.
+    The sqlite backend is used whenever config.sqlite exists; it reads and writes only the followed files a command touches.
+    """
 
     defaults = {
         'files': {},
         'version': __version__,
     }
 
-    def __init__(self, directory=None, autoload=True):
+    backends = ('json', 'sqlite')
+    storages = ('flat', 'objects', 'weave')
+
+    def __init__(self, directory=None, autoload=True, backend=None):
         if directory is None:
             directory = find_configuration()
         self.directory = directory
-        self.path = os.path.join(self.directory, configuration_file_name)
+        if backend is None:
+            backend = 'sqlite' if os.path.exists(os.path.join(self.directory, sqlite_configuration_file_name)) else 'json'
+        self.backend = backend
+        self.path = os.path.join(self.directory, sqlite_configuration_file_name if backend == 'sqlite' else configuration_file_name)
         self.root = os.path.split(self.directory)[0]
         self.update(FragmentsConfig.defaults)
+        self['files'] = {}
+        self.connection = None
+        self.index = FragmentsIndex(self.directory, autoload=autoload)
+        self.ignore = FragmentsIgnore(self.root)
+        self.weaves = FragmentsWeaves(self)
+        self.lines = FragmentsLines(self.directory)
         if autoload:
             self.load()
 
     def load(self):
         if os.access(self.path, os.R_OK|os.W_OK):
-            with open(self.path, 'r') as config_file:
-                file_contents = config_file.read()
             try:
-                parsed_json = json.loads(file_contents)
+                if self.backend == 'sqlite':
+                    self.connection = _connect_sqlite(self.path)
+                    self.update((name, json.loads(value)) for name, value in self.connection.execute('SELECT name, value FROM settings'))
+                    self['files'] = SqliteMapping(self.connection, 'files')
+                else:
+                    self.update(_read_json(self.path))
             except Exception as exc:
                 raise ConfigurationFileCorrupt(exc.args[0])
-            self.update(parsed_json)
             self['version'] = tuple(self['version'])
         else:
             raise ConfigurationFileNotFound("Could not access %r, if the file exists, check its permissions" % self.path)
 
     def dump(self):
         self['version'] = __version__
-        with open(self.path, 'w') as config:
-            config.write(json.dumps(self, sort_keys=True, indent=4))
+        if self.backend == 'sqlite':
+            if self.connection is None:
+                self.connection = _connect_sqlite(self.path)
+                files, self['files'] = self['files'], SqliteMapping(self.connection, 'files')
+                self['files'].update(files)
+            for name, value in self.items():
+                if name != 'files':
+                    self.connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+            self.connection.commit()
+        else:
+            self.export(self.path)
+        self.weaves.dump()
+        self.index.dump()
+        self.lines.dump()
+
+    def export(self, path):
+        """Writes the configuration to path in the config.json format, whichever backend it is stored in"""
+        exported = dict(self)
+        exported['files'] = dict(self['files'].items())
+        with open(path, 'w') as config:
+            config.write(json.dumps(exported, sort_keys=True, indent=4))
+
+    def followed(self, prefix=''):
+        """Returns the sorted keys of followed files that start with prefix"""
+        if isinstance(self['files'], SqliteMapping):
+            return self['files'].keys_with_prefix(prefix)
+        return sorted(key for key in self['files'] if key.startswith(prefix))
+
+
+class FragmentsWeaves(dict):
+    """
+    Weaves of the weave storage, {path: Weave}, each holding the committed versions of the files in one directory as revisions.
+    Weaves are read from _fragments/weaves/ when first needed, and written by dump() if they changed.
+    """
+
+    format_version = 2
+    readable_format_versions = (1, 2)  # version 1 weaves repeated each revision id in every line id
+
+    def __init__(self, config):
+        self.config = config
+        self.changed = set()
+
+    def load(self, path):
+        if path not in self:
+            weave = Weave()
+            if os.path.exists(path):
+                try:
+                    with open(path, 'rb') as weave_file:
+                        stored = json.loads(_decompress(self.config, weave_file.read()).decode('utf8'))
+                    format_version = stored['format']
+                    if format_version in self.readable_format_versions:
+                        weave = Weave.from_dict(stored['weave'])
+                except Exception as exc:
+                    raise ConfigurationFileCorrupt("Could not read weave %r: %s" % (path, exc))
+                if format_version not in self.readable_format_versions:
+                    raise ConfigurationFileCorrupt("Could not read weave %r, it has unknown format %r" % (path, format_version))
+            self[path] = weave
+        return self[path]
+
+    def dump(self):
+        for path in sorted(self.changed):
+            weave = self[path]
+            weave.prune()
+            if not weave.parents:
+                if os.path.exists(path):
+                    os.unlink(path)
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            stored = json.dumps({'format': self.format_version, 'weave': weave.to_dict()}, sort_keys=True, separators=(',', ':'))
+            with open(path + '.tmp', 'wb') as weave_file:
+                weave_file.write(_compress(self.config, stored.encode('utf8')))
+            os.rename(path + '.tmp', path)
+        self.changed.clear()
+
+
+def _connect_sqlite(path):
+    connection = sqlite3.connect(path, check_same_thread=False)  # SqliteMapping serializes access, see status --jobs
+    connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    connection.execute('CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    return connection
+
+
+class SqliteMapping(MutableMapping):
+    """
+    A dict-like view of a (key, value) table, reading and writing one row at a time.
+    Changes are part of the connection's transaction, and are only saved when it is committed.
+    """
+
+    def __init__(self, connection, table):
+        self.connection = connection
+        self.table = table
+        self.lock = threading.Lock()
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql % self.table, parameters).fetchall()
+
+    def __getitem__(self, key):
+        rows = self._execute('SELECT value FROM %s WHERE key = ?', (key,))
+        if not rows:
+            raise KeyError(key)
+        return rows[0][0]
+
+    def __setitem__(self, key, value):
+        self._execute('INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)', (key, value))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._execute('DELETE FROM %s WHERE key = ?', (key,))
+
+    def __contains__(self, key):
+        return bool(self._execute('SELECT 1 FROM %s WHERE key = ?', (key,)))
+
+    def __iter__(self):
+        return iter([key for key, in self._execute('SELECT key FROM %s ORDER BY key')])
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM %s')[0][0]
+
+    def items(self):
+        return self._execute('SELECT key, value FROM %s ORDER BY key')
+
+    def values(self):
+        return [value for value, in self._execute('SELECT value FROM %s ORDER BY key')]
+
+    def keys_with_prefix(self, prefix):
+        """Returns the sorted keys starting with prefix, using the primary key index"""
+        if not prefix:
+            return list(self)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return [key for key, in self._execute('SELECT key FROM %s WHERE key >= ? AND key < ? ORDER BY key', (prefix, upper))]
+
+
+class FragmentsIndex(dict):
+    """
+    Cache of stat data for followed files whose contents match their committed versions, stored next to config.json.
+    It is only ever used to skip work, so a missing or corrupt index is silently rebuilt.
+    """
+
+    def __init__(self, directory, autoload=True):
+        self.path = os.path.join(directory, index_file_name)
+        self.dirty = False
+        if autoload:
+            self.load()
+
+    def __setitem__(self, key, value):
+        self.dirty = True
+        super(FragmentsIndex, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.dirty = True
+        super(FragmentsIndex, self).__delitem__(key)
+
+    def discard(self, key):
+        if key in self:
+            del self[key]
+
+    def load(self):
+        try:
+            self.update(_read_json(self.path))
+        except (IOError, OSError, ValueError, TypeError):
+            self.clear()
+
+    def dump(self):
+        if self.dirty:
+            with open(self.path, 'w') as index_file:
+                index_file.write(json.dumps(self, sort_keys=True))
+            self.dirty = False
+
+
+def _line_digest(line):
+    """Returns a short digest of a line, ignoring its line ending"""
+    return _digest(line.rstrip('\r\n').encode('utf8')).hexdigest()[:16]
+
+
+class FragmentsLines(MutableMapping):
+    """
+    Digests of the distinct lines in the committed version of each followed file, {key: set(line digests)}, stored in lines.sqlite next to config.json.
+    Each file's digests are rows of their own, so committing, renaming or forgetting a file only touches that file's rows.
+    Only opened when first needed, and kept up to date by commit, rename and forget; changes are saved by dump().
+    Each file's rows record the digest of the committed version they were made from, so rows that are missing, or were made from
+    a committed version since replaced some other way, such as by a version control checkout, can be told apart and rebuilt.
+    Digests can collide, so it can only ever rule files out.
+    It is only ever used to skip work, so a corrupt one is silently replaced by an empty one.
+    """
+
+    format_version = 2
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, lines_file_name)
+        self.connection = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        if connection.execute('PRAGMA user_version').fetchone()[0] != self.format_version:
+            connection.execute('DROP TABLE IF EXISTS files')
+            connection.execute('DROP TABLE IF EXISTS lines')
+            connection.execute('PRAGMA user_version = %d' % self.format_version)
+        connection.execute('CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, snapshot TEXT)')
+        # digests are stored as signed 64 bit integers, which sqlite stores in 8 bytes or less
+        connection.execute('CREATE TABLE IF NOT EXISTS lines (file INTEGER NOT NULL, digest INTEGER NOT NULL, PRIMARY KEY (file, digest)) WITHOUT ROWID')
+        connection.execute('CREATE INDEX IF NOT EXISTS lines_by_digest ON lines (digest)')
+        return connection
+
+    def load(self):
+        if self.connection is None:
+            try:
+                self.connection = self._connect()
+            except sqlite3.DatabaseError:
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                self.connection = self._connect()
+        return self
+
+    def _execute(self, sql, parameters=()):
+        return self.load().connection.execute(sql, parameters).fetchall()
+
+    @staticmethod
+    def _to_integer(line_digest):
+        return int(line_digest, 16) - (1 << 63)
+
+    @staticmethod
+    def _from_integer(value):
+        return '%016x' % (value + (1 << 63))
+
+    def __getitem__(self, key):
+        rows = self._execute('SELECT digest FROM lines JOIN files ON lines.file = files.id WHERE files.key = ?', (key,))
+        if not rows:
+            raise KeyError(key)
+        return set(self._from_integer(value) for value, in rows)
+
+    def __setitem__(self, key, digests):
+        self.discard(key)
+        file_id = self.connection.execute('INSERT INTO files (key) VALUES (?)', (key,)).lastrowid
+        self.connection.executemany('INSERT INTO lines (file, digest) VALUES (?, ?)', ((file_id, self._to_integer(digest)) for digest in set(digests)))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.discard(key)
+
+    def __contains__(self, key):
+        return bool(self._execute('SELECT 1 FROM files WHERE key = ?', (key,)))
+
+    def __iter__(self):
+        return iter([key for key, in self._execute('SELECT key FROM files ORDER BY key')])
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM files')[0][0]
+
+    def add(self, key, lines, snapshot_digest):
+        """Records lines as the committed contents of key, whose digest is snapshot_digest"""
+        self[key] = set(_line_digest(line) for line in lines)
+        self.connection.execute('UPDATE files SET snapshot = ? WHERE key = ?', (snapshot_digest, key))
+
+    def describes(self, key, snapshot_digest):
+        """Whether the rows for key were made from its committed version with snapshot_digest"""
+        return bool(self._execute('SELECT 1 FROM files WHERE key = ? AND snapshot = ?', (key, snapshot_digest)))
+
+    def has_lines(self, key):
+        """Whether the committed version of key has any line, without loading its digests"""
+        return self._execute('SELECT EXISTS (SELECT 1 FROM lines JOIN files ON lines.file = files.id WHERE files.key = ?)', (key,))[0][0] == 1
+
+    def discard(self, key):
+        self._execute('DELETE FROM lines WHERE file IN (SELECT id FROM files WHERE key = ?)', (key,))
+        self._execute('DELETE FROM files WHERE key = ?', (key,))
+
+    def rename(self, old_key, new_key):
+        if old_key in self:
+            self.discard(new_key)
+            self._execute('UPDATE files SET key = ? WHERE key = ?', (new_key, old_key))
+
+    def files_with_line(self, line_digest):
+        """Returns the set of keys whose committed versions contain a line with line_digest"""
+        rows = self._execute('SELECT files.key FROM lines JOIN files ON lines.file = files.id WHERE lines.digest = ?', (self._to_integer(line_digest),))
+        return set(key for key, in rows)
+
+    def dump(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+
+def _pattern_to_regex(pattern):
+    """Translates a gitignore-style glob into a regular expression: * and ? don't match /, **/ matches any number of directories"""
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i+2)
+            regex += '[' + pattern[i+1:end].replace('!', '^', 1 if pattern[i+1] == '!' else 0).replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r'\Z')
+
+
+class FragmentsIgnore(list):
+    """
+    Patterns from the .fragmentsignore file in the repository root, in gitignore format.
+    Ignored files, and everything below ignored directories, are never looked at when searching for unfollowed files.
+    """
+
+    def __init__(self, root):
+        self.path = os.path.join(root, ignore_file_name)
+        self.load()
+
+    def load(self):
+        del self[:]
+        try:
+            with open(self.path, 'r') as ignore_file:
+                lines = ignore_file.read().splitlines()
+        except (IOError, OSError):
+            return
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated or line.startswith('\\'):
+                line = line[1:]
+            directories_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line  # patterns containing a slash match the whole path, others match any file or directory name
+            self.append((_pattern_to_regex(line.lstrip('/')), negated, directories_only, anchored))
+
+    def match(self, key, is_dir=False):
+        """Whether the file or directory at key, relative to the repository root, is ignored. The last matching pattern wins"""
+        ignored = False
+        name = key.rsplit('/', 1)[-1]
+        for regex, negated, directories_only, anchored in self:
+            if directories_only and not is_dir:
+                continue
+            if regex.match(key if anchored else name):
+                ignored = not negated
+        return ignored
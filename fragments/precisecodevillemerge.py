@@ -3,19 +3,21 @@
 # That code was in turn based on BSD-licensed code from the Codeville distributed version control system
 # -*- coding: utf-8
 from __future__ import unicode_literals
-try:
-    xrange
-except NameError:  # Python3 compatibility
-    xrange = range
 
 from bisect import bisect
 
 
-def unique_lcs(a, b):
+def unique_lcs(a, b, alo=0, ahi=None, blo=0, bhi=None):
+    # works on a[alo:ahi] and b[blo:bhi] without copying them,
+    # positions in the result are positions in a and b
+    if ahi is None:
+        ahi = len(a)
+    if bhi is None:
+        bhi = len(b)
     # set index[line in a] = position of line in a unless
     # unless a is a duplicate, in which case it's set to None
     index = {}
-    for i in xrange(len(a)):
+    for i in range(alo, ahi):
         line = a[i]
         if line in index:
             index[line] = None
@@ -24,9 +26,10 @@ def unique_lcs(a, b):
     # make btoa[i] = position of line i in a, unless
     # that line doesn't occur exactly once in both,
     # in which case it's set to None
-    btoa = [None] * len(b)
+    btoa = [None] * (bhi - blo)
     index2 = {}
-    for pos, line in enumerate(b):
+    for pos in range(blo, bhi):
+        line = b[pos]
         next = index.get(line)
         if next is not None:
             if line in index2:
@@ -35,11 +38,11 @@ def unique_lcs(a, b):
                 btoa[index2[line]] = None
                 del index[line]
             else:
-                index2[line] = pos
-                btoa[pos] = next
+                index2[line] = pos - blo
+                btoa[pos - blo] = next
     # this is the Patience sorting algorithm
     # see http://en.wikipedia.org/wiki/Patience_sorting
-    backpointers = [None] * len(b)
+    backpointers = [None] * (bhi - blo)
     stacks = []
     lasts = []
     k = 0
@@ -69,17 +72,72 @@ def unique_lcs(a, b):
     result = []
     k = lasts[-1]
     while k is not None:
-        result.append((btoa[k], k))
+        result.append((btoa[k], k + blo))
         k = backpointers[k]
     result.reverse()
     return result
 
 
-def recurse_matches(a, b, ahi, bhi, answer, maxrecursion):
-    if maxrecursion < 0:  # pragma: no cover
-        # this will never happen normally, this check is to prevent DOS attacks
-        return
-    oldlength = len(answer)
+def recurse_matches(a, b, ahi, bhi, answer, maxrecursion=None):
+    # the recursion is kept on an explicit stack, so there is no limit
+    # to how deep it goes unless maxrecursion is given. each entry is
+    # (ahi, bhi, depth) to find the matches up to ahi and bhi, or
+    # (apos, bpos, None) to add a match which was already found
+    stack = [(ahi, bhi, 0)]
+    while stack:
+        ahi, bhi, depth = stack.pop()
+        if depth is None:
+            answer.append((ahi, bhi))
+            continue
+        if maxrecursion is not None and depth > maxrecursion:
+            continue
+        if len(answer) == 0:
+            alo, blo = 0, 0
+        else:
+            alo, blo = answer[-1]
+            alo += 1
+            blo += 1
+        if alo == ahi or blo == bhi:
+            continue
+        matches = unique_lcs(a, b, alo, ahi, blo, bhi)
+        if matches:
+            # recurse between lines which are unique in each file and match,
+            # then find matches between the last match and the end
+            pending = []
+            lasta, lastb = alo - 1, blo - 1
+            for apos, bpos in matches:
+                # there is nothing to match between adjacent lines
+                if apos > lasta + 1 and bpos > lastb + 1:
+                    pending.append((apos, bpos, depth + 1))
+                pending.append((apos, bpos, None))
+                lasta, lastb = apos, bpos
+            pending.append((ahi, bhi, depth + 1))
+            pending.reverse()
+            stack.extend(pending)
+        elif a[alo] == b[blo]:
+            # find matching lines at the very beginning
+            while alo < ahi and blo < bhi and a[alo] == b[blo]:
+                answer.append((alo, blo))
+                alo += 1
+                blo += 1
+            stack.append((ahi, bhi, depth + 1))
+        elif a[ahi - 1] == b[bhi - 1]:
+            # find matching lines at the very end
+            nahi = ahi - 1
+            nbhi = bhi - 1
+            while nahi > alo and nbhi > blo and a[nahi - 1] == b[nbhi - 1]:
+                nahi -= 1
+                nbhi -= 1
+            for i in reversed(range(ahi - nahi)):
+                stack.append((nahi + i, nbhi + i, None))
+            stack.append((nahi, nbhi, depth + 1))
+
+
+def trimmed_matches(a, b, ahi, bhi, answer, maxrecursion=None):
+    # same as recurse_matches, but matches a common head and tail
+    # directly, so only the lines between them go through unique_lcs.
+    # this gives the same answer as long as no line of the head or tail
+    # appears between them, otherwise fall back to recurse_matches
     if len(answer) == 0:
         alo, blo = 0, 0
     else:
@@ -88,32 +146,24 @@ def recurse_matches(a, b, ahi, bhi, answer, maxrecursion):
         blo += 1
     if alo == ahi or blo == bhi:
         return
-    for apos, bpos in unique_lcs(a[alo:ahi], b[blo:bhi]):
-        # recurse between lines which are unique in each file and match
-        apos += alo
-        bpos += blo
-        recurse_matches(a, b, apos, bpos, answer, maxrecursion - 1)
-        answer.append((apos, bpos))
-    if len(answer) > oldlength:
-        # find matches between the last match and the end
-        recurse_matches(a, b, ahi, bhi, answer, maxrecursion - 1)
-    elif a[alo] == b[blo]:
-        # find matching lines at the very beginning
-        while alo < ahi and blo < bhi and a[alo] == b[blo]:
-            answer.append((alo, blo))
-            alo += 1
-            blo += 1
-        recurse_matches(a, b, ahi, bhi, answer, maxrecursion - 1)
-    elif a[ahi - 1] == b[bhi - 1]:
-        # find matching lines at the very end
-        nahi = ahi - 1
-        nbhi = bhi - 1
-        while nahi > alo and nbhi > blo and a[nahi - 1] == b[nbhi - 1]:
-            nahi -= 1
-            nbhi -= 1
-        recurse_matches(a, b, nahi, nbhi, answer, maxrecursion - 1)
-        for i in xrange(ahi - nahi):
-            answer.append((nahi + i, nbhi + i))
+    head = 0
+    while alo + head < ahi and blo + head < bhi and a[alo + head] == b[blo + head]:
+        head += 1
+    tail = 0
+    while ahi - tail > alo + head and bhi - tail > blo + head and a[ahi - tail - 1] == b[bhi - tail - 1]:
+        tail += 1
+    if head or tail:
+        middle = set(a[alo + head:ahi - tail])
+        middle.update(b[blo + head:bhi - tail])
+        if middle.isdisjoint(a[alo:alo + head]) and middle.isdisjoint(a[ahi - tail:ahi]):
+            for i in range(head):
+                answer.append((alo + i, blo + i))
+            if alo + head < ahi - tail and blo + head < bhi - tail:
+                recurse_matches(a, b, ahi - tail, bhi - tail, answer, maxrecursion)
+            for i in range(tail):
+                answer.append((ahi - tail + i, bhi - tail + i))
+            return
+    recurse_matches(a, b, ahi, bhi, answer, maxrecursion)
 
 
 class Weave(object):
@@ -132,6 +182,32 @@ class Weave(object):
         # is used.
         # the merge between two states is the greater of the two values
         self.newedgestates = {}
+        # {line: small integer}, lines are matched as these integers and
+        # each distinct line is stored once
+        self.symbols = {}
+        # [line], indexed by symbol
+        self.symbol_lines = []
+        # [symbol] of each line in self.weave, None until needed
+        self.weave_symbols = None
+
+    def _intern(self, lines):
+        # returns the symbols of lines, giving lines which are new to the
+        # table the next unused symbols
+        table = self.symbols
+        symbol_lines = self.symbol_lines
+        symbols = []
+        for line in lines:
+            symbol = table.get(line)
+            if symbol is None:
+                symbol = table[line] = len(symbol_lines)
+                symbol_lines.append(line)
+            symbols.append(symbol)
+        return symbols
+
+    def _weave_symbols(self):
+        if self.weave_symbols is None:
+            self.weave_symbols = self._intern([line for (lineid, line) in self.weave])
+        return self.weave_symbols
 
     def add_revision(self, revid, lines, parents):
         assert revid not in self.parents
@@ -153,22 +229,29 @@ class Weave(object):
                 if idb is not None:
                     alivepost.add(idb)
         living = alivepre.intersection(alivepost)
+        symbols = self._intern(lines)
+        symbol_lines = self.symbol_lines
+        symbols2 = self._weave_symbols()
         mapping = []
-        livinglines = []
+        livingsymbols = []
         for (pos, (lineid, line)) in enumerate(self.weave):
             if lineid in living:
                 mapping.append(pos)
-                livinglines.append(line)
+                livingsymbols.append(symbols2[pos])
         matches2 = []
-        recurse_matches(lines, livinglines, len(lines), len(livinglines), matches2, 10)
+        trimmed_matches(symbols, livingsymbols, len(symbols), len(livingsymbols), matches2)
 
         # match against the whole weave
         matches = []
-        lines2 = [line for (lineid, line) in self.weave]
+        lastp, lastq = -1, -1
         for p, q in matches2:
-            recurse_matches(lines, lines2, p, mapping[q], matches, 10)
-            matches.append((p, mapping[q]))
-        recurse_matches(lines, lines2, len(lines), len(lines2), matches, 10)
+            q = mapping[q]
+            # there is nothing to match between adjacent lines
+            if p > lastp + 1 and q > lastq + 1:
+                trimmed_matches(symbols, symbols2, p, q, matches)
+            matches.append((p, q))
+            lastp, lastq = p, q
+        trimmed_matches(symbols, symbols2, len(symbols), len(symbols2), matches)
 
         # build a new weave
         alledges = set()
@@ -176,9 +259,10 @@ class Weave(object):
             for (edge, state) in i:
                 alledges.add(edge)
         newweave = []
+        newsymbols = []
         revpos = -1
         weavepos = -1
-        matches.append((len(lines), len(lines2)))
+        matches.append((len(lines), len(symbols2)))
         currentlines = []
         for a, b in matches:
             # take a guess as to whether it's better to put
@@ -192,24 +276,29 @@ class Weave(object):
             if hit:
                 # add current weave lines to the new weave
                 newweave.extend(self.weave[weavepos + 1:b])
+                newsymbols.extend(symbols2[weavepos + 1:b])
             # add lines which have never appeared before to the weave
-            for i in xrange(revpos + 1, a):
+            for i in range(revpos + 1, a):
                 lineid = (revid, i)
                 currentlines.append(lineid)
-                newweave.append((lineid, lines[i]))
+                newweave.append((lineid, symbol_lines[symbols[i]]))  # equal lines share one string
+                newsymbols.append(symbols[i])
             if not hit:
                 # add current weave lines to the new weave
                 newweave.extend(self.weave[weavepos + 1:b])
-            if b != len(lines2):
+                newsymbols.extend(symbols2[weavepos + 1:b])
+            if b != len(symbols2):
                 newweave.append(self.weave[b])
+                newsymbols.append(symbols2[b])
                 currentlines.append(self.weave[b][0])
             revpos = a
             weavepos = b
         self.weave = newweave
+        self.weave_symbols = newsymbols
         # calculate which lines had their states changed in this revision
         currentedges = set()
         if len(currentlines) > 0:
-            for i in xrange(len(currentlines) - 1):
+            for i in range(len(currentlines) - 1):
                 currentedges.add((currentlines[i], currentlines[i+1]))
             currentedges.add((None, currentlines[0]))
             currentedges.add((currentlines[-1], None))
@@ -324,3 +413,77 @@ class Weave(object):
                 if lineid in blines:
                     bpartial.append(line)
         return result
+
+    def remove_revision(self, revid):
+        # forgets a revision that no other revision is based on
+        # its lines stay in the weave until prune() is called
+        for p in self.parents.values():
+            assert revid not in p
+        del self.parents[revid]
+        self.newedgestates.pop(revid, None)
+
+    def prune(self):
+        # drops lines which are not alive in any remaining revision,
+        # merges only ever look at edges between living lines
+        alive = set()
+        for revid in self.parents:
+            alive.update(self._lineids(self._make_vals(revid)))
+        self.weave = [(lineid, line) for (lineid, line) in self.weave if lineid in alive]
+        self.weave_symbols = None
+
+    def copy(self):
+        # returns a weave that revisions can be added to without changing
+        # this one; add_revision() replaces self.weave and self.weave_symbols
+        # and only adds keys to self.parents and self.newedgestates, so those
+        # can be shared
+        w = Weave()
+        w.weave = self.weave
+        w.parents = dict(self.parents)
+        w.newedgestates = dict(self.newedgestates)
+        w.weave_symbols = self._weave_symbols()
+        w.symbols = dict(self.symbols)
+        w.symbol_lines = list(self.symbol_lines)
+        return w
+
+    def to_dict(self):
+        # returns the weave as lists and dicts that can be serialized as JSON,
+        # as long as revision ids and lines can be; each revision id is stored
+        # once in 'revisions', and line ids refer to it by its index there
+        revisions = {}
+        def index(revid):
+            return revisions.setdefault(revid, len(revisions))
+        def lineid(l):
+            return None if l is None else [index(l[0]), l[1]]
+        for revid in self.parents:
+            index(revid)
+        d = {
+            'weave': [[lineid(l), line] for (l, line) in self.weave],
+            'parents': [[index(revid), [index(p) for p in parents]] for (revid, parents) in self.parents.items()],
+            'newedgestates': [
+                [index(revid), [[lineid(ida), lineid(idb), state] for ((ida, idb), state) in edgestates]]
+                for (revid, edgestates) in self.newedgestates.items()
+            ],
+        }
+        d['revisions'] = sorted(revisions, key=revisions.get)
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        # the inverse of to_dict(), also reading dicts written before revision
+        # ids were stored by index, which have no 'revisions'
+        if 'revisions' in d:
+            revisions = d['revisions']
+        else:
+            revisions = None
+        def revid(r):
+            return r if revisions is None else revisions[r]
+        def lineid(l):
+            return None if l is None else (revid(l[0]), l[1])
+        w = cls()
+        w.weave = [(lineid(l), line) for (l, line) in d['weave']]
+        w.parents = dict((revid(r), [revid(p) for p in parents]) for (r, parents) in d['parents'])
+        w.newedgestates = dict(
+            (revid(r), [((lineid(ida), lineid(idb)), state) for (ida, idb, state) in edgestates])
+            for (r, edgestates) in d['newedgestates']
+        )
+        return w
@@ -0,0 +1,226 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import struct
+import socket
+import argparse
+import traceback
+from io import StringIO
+
+from . import FragmentsError, _use_watched_statuses
+from .config import FragmentsConfig, ConfigurationError, find_configuration, _cache_json_files
+from .watch import Watcher, WatchError
+from . import color
+
+
+server_socket_name = 'serve.sock'
+_local_commands = ('init', 'watch', 'serve')  # commands that must not be run by the server
+
+
+class ServeError(FragmentsError): pass
+
+
+def _send(wfile, **message):
+    wfile.write(json.dumps(message) + '\n')
+    wfile.flush()
+
+
+def _receive(rfile):
+    line = rfile.readline()
+    if not line:
+        raise ServeError("Connection to fragments server closed unexpectedly")
+    return json.loads(line)
+
+
+def _peer_uid(connection):
+    """Returns the user id of the process at the other end of a Unix domain socket, or None if the platform can't tell"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None  # the socket is only accessible to our user anyway, see serve()
+    credentials = struct.Struct(str('3i'))  # struct ucred: pid, uid, gid
+    pid, uid, gid = credentials.unpack(connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, credentials.size))
+    return uid
+
+
+def _inside(path, root):
+    return path == root or path.startswith(os.path.join(root, ''))
+
+
+def _handle(connection, cwd, root, statuses=None):
+    """
+    Runs one command for a client in its working directory, which must be inside root, then returns to cwd.
+    The status command takes the status of followed files from statuses, if given.
+    Returns False if the client asked the server to stop.
+    """
+    from . import commands
+    rfile = connection.makefile('r', encoding='utf8')
+    wfile = connection.makefile('w', encoding='utf8')
+    request = _receive(rfile)
+    if _peer_uid(connection) not in (None, os.getuid()):
+        _send(wfile, error="Fragments server only runs commands for the user that started it")
+        return True
+    if request.get('stop'):
+        _send(wfile, done=True)
+        return False
+
+    if request['command'] not in commands.__all__ or request['command'] in _local_commands:
+        _send(wfile, error="Command '%s' can not be run by the fragments server" % request['command'])
+        return True
+    if not _inside(os.path.realpath(request['cwd']), root):
+        _send(wfile, error="Fragments server for '%s' can not run commands in '%s'" % (root, request['cwd']))
+        return True
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = captured = StringIO()  # argparse writes help and usage errors here
+    result = {'done': True}
+    if request['command'] == 'status':
+        _use_watched_statuses(statuses)
+    try:
+        os.chdir(request['cwd'])
+        command_generator = getattr(commands, request['command'])(*request['args'])
+        l = next(command_generator)
+        while True:
+            if isinstance(l, color.Prompt):
+                _send(wfile, prompt=l[:-1])  # Prompt() appends a space
+                l = command_generator.send(_receive(rfile)['response'])
+            else:
+                _send(wfile, line=l, color=type(l).__name__ if isinstance(l, color.ColoredString) else None)
+                l = next(command_generator)
+    except StopIteration:
+        pass
+    except FragmentsError as exc:
+        result = {'error': exc.args[0]}
+    except SystemExit as exc:
+        result = {'output': captured.getvalue(), 'exit': exc.code}
+    except Exception as exc:  # pragma: no cover
+        traceback.print_exc(file=stderr)
+        result = {'error': "Fragments server failed running '%s': %r" % (request['command'], exc)}
+    finally:
+        _use_watched_statuses()
+        sys.stdout, sys.stderr = stdout, stderr
+        os.chdir(cwd)
+    _send(wfile, **result)
+    return True
+
+
+def _socket_path(config):
+    return os.path.join(config.directory, server_socket_name)
+
+
+def _connect(directory=None):
+    """Connects to the server for the current fragments repository, returns None if none is running"""
+    try:
+        directory = directory or find_configuration()
+    except ConfigurationError:
+        return None
+    path = os.path.join(directory, server_socket_name)
+    if not os.path.exists(path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+
+def _remote(connection, command, *args):
+    """Runs a command on the server, behaving like the command itself: lines are yielded, and prompts accept a response with send()"""
+    try:
+        rfile = connection.makefile('r', encoding='utf8')
+        wfile = connection.makefile('w', encoding='utf8')
+        _send(wfile, command=command, args=list(args), cwd=os.getcwd())
+        while True:
+            message = _receive(rfile)
+            if 'prompt' in message:
+                response = (yield color.Prompt(message['prompt']))
+                _send(wfile, response=response)
+            elif 'line' in message:
+                line_class = getattr(color, message['color'] or '', None)
+                if line_class is None or not issubclass(line_class, color.ColoredString):
+                    yield message['line']
+                else:
+                    yield type('').__new__(line_class, message['line'])
+            elif 'error' in message:
+                raise ServeError(message['error'])
+            elif 'exit' in message:
+                for l in message['output'].splitlines():
+                    yield l
+                raise SystemExit(message['exit'])
+            else:
+                return
+    finally:
+        connection.close()
+
+
+def serve(*args):
+    """
+    Serve fragments commands to other fragments processes over a Unix domain socket in the _fragments/ directory, until interrupted.
+    While a server is running, fragments commands in this repository are run by the server, which keeps config.json and index.json parsed in memory, reparsing them only when they change.
+    On Linux, the server also watches followed files like the watch command, and answers status from what it has seen change.
+    Commands are run one at a time, only for the user that started the server, and only in directories inside the repository.
+    """
+    parser = argparse.ArgumentParser(prog="%s %s" % (__package__, serve.__name__), description=serve.__doc__)
+    parser.add_argument('--stop', action="store_true", default=False, dest="stop", help="stop the server for this repository")
+    args = parser.parse_args(args)
+
+    config = FragmentsConfig()
+    path = _socket_path(config)
+    connection = _connect(config.directory)
+    if args.stop:
+        if connection is None:
+            yield "No fragments server running in '%s'" % config.directory
+            return
+        with connection:
+            wfile = connection.makefile('w', encoding='utf8')
+            _send(wfile, stop=True)
+            response = _receive(connection.makefile('r', encoding='utf8'))
+        if 'error' in response:
+            raise ServeError(response['error'])
+        yield "Stopped fragments server in '%s'" % config.directory
+        return
+
+    if connection is not None:
+        connection.close()
+        raise ServeError("A fragments server is already running in '%s'" % config.directory)
+    if os.path.exists(path):
+        os.unlink(path)  # left behind by a server that did not shut down cleanly
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)  # the socket is created readable and writable by our user only, there is no window for others to connect
+    try:
+        listener.bind(path)
+    except socket.error as exc:
+        listener.close()
+        raise ServeError("Could not serve fragments commands on '%s': %s" % (path, exc))
+    finally:
+        os.umask(umask)
+    listener.listen(5)
+    _cache_json_files()
+    cwd = os.getcwd()
+    root = os.path.realpath(config.root)
+    try:
+        watcher = Watcher(config)
+    except WatchError:
+        watcher = None  # no inotify, the status command checks every file
+    try:
+        yield "Serving fragments commands on '%s'" % path
+        running = True
+        while running:
+            connection, address = listener.accept()
+            if watcher is not None:
+                watcher.catch_up()
+            with connection:
+                try:
+                    running = _handle(connection, cwd, root, statuses=None if watcher is None else watcher.statuses)
+                except (ServeError, socket.error, ValueError):
+                    pass  # client went away or sent garbage, carry on serving the others
+    finally:
+        if watcher is not None:
+            watcher.close()
+        _cache_json_files(False)
+        listener.close()
+        os.unlink(path)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8
+from __future__ import unicode_literals
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import argparse
+
+from . import FragmentsError, _file_status, _snapshot_path
+from .config import FragmentsConfig, ConfigurationError
+
+
+class WatchError(FragmentsError): pass
+
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+_watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_event_header = struct.Struct(str('iIII'))  # struct inotify_event: wd, mask, cookie, len; followed by len bytes of name
+
+
+class _Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify API"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            raise WatchError("Could not watch files, inotify is not available on this platform")
+        if self.fd < 0:
+            raise WatchError("Could not watch files, inotify_init1 failed: %s" % os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask=_watch_mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def pending(self):
+        """Returns True if events are waiting to be read"""
+        readable, _, _ = select.select([self.fd], [], [], 0)
+        return bool(readable)
+
+    def read(self, timeout=None):
+        """Waits up to timeout seconds for events, returns a list of (wd, mask, name)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise  # pragma: no cover
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """
+    Keeps the status of every followed file in memory, using inotify to recheck only the files that change.
+    Statuses are computed by _file_status, so they are the same as those shown by the status command.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.inotify = _Inotify()
+        self.statuses = {}     # {path: status}
+        self.directories = {}  # {wd: directory path}
+        self.watches = {}      # {directory path: wd}
+        self._watch(config.directory)
+        self.refresh()
+
+    def _watch(self, directory):
+        if directory not in self.watches:
+            try:
+                wd = self.inotify.add_watch(directory)
+            except OSError:
+                return  # directory vanished before we could watch it; its parent will tell us if it comes back
+            self.watches[directory] = wd
+            self.directories[wd] = directory
+
+    def _followed_paths(self):
+        return set(os.path.join(self.config.root, key) for key in self.config['files'])
+
+    def _sync_watches(self):
+        """Watches every existing directory that contains a followed file, directly or indirectly"""
+        for path in self._followed_paths():
+            directory = os.path.dirname(path)
+            while directory.startswith(self.config.root) and directory not in self.watches:
+                if os.path.isdir(directory):
+                    self._watch(directory)
+                directory = os.path.dirname(directory)
+
+    def _recheck(self, paths):
+        """Recomputes the status of paths, returns [(status, path)] for those whose status changed"""
+        changes = []
+        for path in paths:
+            s = _file_status(self.config, path)
+            if self.statuses.get(path) != s:
+                changes.append((s, path))
+                if s == '?':
+                    del self.statuses[path]
+                else:
+                    self.statuses[path] = s
+        return changes
+
+    def refresh(self, prefix=None):
+        """Rechecks every followed file, or every followed file below prefix, returns [(status, path)] for those whose status changed"""
+        self._sync_watches()
+        self._snapshots = {}  # {committed file name: path}, for committed files stored directly in _fragments/
+        for key in self.config['files']:
+            snapshot_path = _snapshot_path(self.config, key)
+            if snapshot_path is not None and os.path.dirname(snapshot_path) == self.config.directory:
+                self._snapshots[os.path.basename(snapshot_path)] = os.path.join(self.config.root, key)
+        paths = self._followed_paths() | set(self.statuses)  # includes files that are no longer followed, so they can be dropped
+        if prefix is not None:
+            paths = [p for p in paths if p.startswith(os.path.join(prefix, ''))]
+        return self._recheck(paths)
+
+    def _reload(self):
+        try:
+            config = FragmentsConfig(self.config.directory)
+        except ConfigurationError:
+            return []  # caught config.json half written, the event for the rest of the write will bring us back here
+        self.config.index.dump()
+        self.config = config
+        return self.refresh()
+
+    def poll(self, timeout=None):
+        """Waits up to timeout seconds for changes, returns a sorted list of (status, path) for files whose status changed"""
+        events = self.inotify.read(timeout)
+        changed_paths = set()
+        changes = []
+        reload_config = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                reload_config = True  # we've lost track of what changed, recheck everything
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:  # directory was removed, inotify dropped the watch
+                del self.directories[wd]
+                del self.watches[directory]
+                continue
+            if mask & IN_MOVE_SELF:  # the watch now follows the directory to a path we don't know
+                self.inotify.rm_watch(wd)
+                continue
+            if mask & IN_DELETE_SELF:
+                continue  # the parent directory reports this too
+            path = os.path.join(directory, name)
+            if directory == self.config.directory:
+                if name == os.path.basename(self.config.path):
+                    reload_config = True
+                elif name in self._snapshots:
+                    changed_paths.add(self._snapshots[name])
+            elif mask & IN_ISDIR:
+                changes.extend(self.refresh(prefix=path))  # a directory came or went, along with any followed files in it
+            elif path in self.statuses:
+                changed_paths.add(path)
+        if reload_config:
+            changes.extend(self._reload())
+        else:
+            changes.extend(self._recheck(changed_paths))
+        self.config.index.dump()
+        return sorted(changes)
+
+    def catch_up(self):
+        """Handles every event already waiting, without waiting for more, so statuses include every change made so far"""
+        while self.inotify.pending():
+            self.poll(0)
+
+    def close(self):
+        self.config.index.dump()
+        self.inotify.close()
+
+
+def watch(*args):
+    """
+    Watch followed files for changes, limited to FILENAME(s) if specified; only available on Linux.
+    Shows the status of each followed file, then shows it again each time it changes, until interrupted.
+    Limit output to files with status STATUS, if present.
+    """
+    parser = argparse.ArgumentParser(prog="%s %s" % (__package__, watch.__name__), description=watch.__doc__)
+    parser.add_argument('FILENAME', help="files to watch", nargs="*", default=['.'])
+    parser.add_argument('-l', '--limit', type=str, dest="STATUS", default='MDAE ', action="store", help="limit to files in STATUS")
+    args = parser.parse_args(args)
+
+    from .commands import _status_to_color
+
+    config = FragmentsConfig()
+    watched_paths = [os.path.realpath(f) for f in args.FILENAME]
+
+    def _watched(path):
+        return any(path == p or path.startswith(os.path.join(p, '')) for p in watched_paths)
+
+    watcher = Watcher(config)
+    try:
+        yield "%s configuration version %s.%s.%s" % ((__package__,) + config['version'])
+        yield "watching %s" % config.directory
+        for path, s in sorted(watcher.statuses.items(), key=lambda ps: (ps[1], ps[0])):
+            if s in args.STATUS and _watched(path):
+                yield _status_to_color.get(s, str)('%s\t%s' % (s, os.path.relpath(path)))
+        shown = set(path for path, s in watcher.statuses.items() if s in args.STATUS)
+        while True:
+            for s, path in watcher.poll():
+                if (s in args.STATUS or path in shown) and _watched(path):  # also show files leaving the limited statuses
+                    yield _status_to_color.get(s, str)('%s\t%s' % (s, os.path.relpath(path)))
+                if s in args.STATUS:
+                    shown.add(path)
+                else:
+                    shown.discard(path)
+    finally:
+        watcher.close()
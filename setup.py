@@ -1,16 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8
-import sys
-
 try:
     from setuptools import setup
 except ImportError:
     from distutils.core import setup
 
-install_requires = []
-if sys.version_info < (2, 7):
-    install_requires.append('argparse')
-
 import fragments
 
 setup(
@@ -22,7 +16,7 @@ setup(
     author_email='matt-fragments@theory.org',
     url='https://github.com/glyphobet/fragments',
     packages=['fragments'],
-    install_requires=install_requires,
+    python_requires='>=3.7',
     entry_points={
         'console_scripts': [
             'fragments = fragments.commands:_main',
@@ -36,10 +30,13 @@ setup(
         'Natural Language :: English',
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.2',
-        'Programming Language :: Python :: 3.3',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: Implementation',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
@@ -3,10 +3,7 @@ from __future__ import unicode_literals
 
 import os
 import sys
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
+from io import StringIO
 import unittest
 from fragments import color
 
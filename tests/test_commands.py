@@ -2,22 +2,29 @@
 from __future__ import unicode_literals
 
 import os
+import sys
 import json
+import zlib
+import lzma
 import time
 import types
 import codecs
+import stat
 import shutil
+import hashlib
 import argparse
 import tempfile
 import unittest
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
+import threading
+from io import StringIO
+from unittest import mock
 
-from fragments import commands, __version__
+from fragments import commands, color, __version__, _weave_path, _snapshot_path
 from fragments.commands import ExecutionError
-from fragments.config import configuration_file_name, configuration_directory_name, ConfigurationDirectoryNotFound, FragmentsConfig
+from fragments.watch import Watcher, WatchError
+from fragments.serve import ServeError, server_socket_name, _connect, _remote
+from fragments.precisecodevillemerge import Weave
+from fragments.config import _line_digest, lines_file_name, configuration_file_name, sqlite_configuration_file_name, configuration_directory_name, ConfigurationDirectoryNotFound, FragmentsConfig
 
 
 def help  (*a): return list(commands.help  (*a))
@@ -32,6 +39,9 @@ def commit(*a): return list(commands.commit(*a))
 def revert(*a): return list(commands.revert(*a))
 def diff  (*a): return list(commands.diff  (*a))
 def apply (*a): return list(commands.apply (*a))
+def serve (*a): return list(commands.serve (*a))
+def export(*a): return list(commands.export(*a))
+def search(*a): return list(commands.search(*a))
 
 
 class CommandBase(unittest.TestCase):
@@ -68,25 +78,6 @@ class CommandBase(unittest.TestCase):
             new_file.write(contents)
         return rel_path, file_path
 
-    # The following three methods are for Python 2.6 support
-    def assertIn(self, item, iterable, msg=None):
-        if hasattr(super(CommandBase, self), 'assertIn'):
-            return super(CommandBase, self).assertIn(item, iterable, msg=msg)
-        else:
-            return self.assertTrue(item in iterable, msg=msg)
-
-    def assertNotIn(self, item, iterable, msg=None):
-        if hasattr(super(CommandBase, self), 'assertNotIn'):
-            return super(CommandBase, self).assertNotIn(item, iterable, msg=msg)
-        else:
-            return self.assertFalse(item in iterable, msg=msg)
-
-    def assertIsInstance(self, obj, cls, msg=None):
-        if hasattr(super(CommandBase, self), 'assertIsInstance'):
-            return super(CommandBase, self).assertIsInstance(obj, cls, msg=msg)
-        else:
-            return self.assertTrue(isinstance(obj, cls), msg=msg)
-
 
 class TestConfig(CommandBase):
 
@@ -175,6 +166,24 @@ class TestInitCommand(CommandBase):
         self.assertTrue(os.path.exists(os.path.join(self.path, configuration_directory_name, configuration_file_name)))
         self.assertTrue(os.path.exists(os.path.join(self.path, configuration_directory_name, configuration_file_name + '.corrupt')))
 
+    def test_init_sqlite(self):
+        init('--backend', 'sqlite')
+        self.assertFalse(os.path.exists(os.path.join(self.path, configuration_directory_name, configuration_file_name)))
+        self.assertTrue(os.path.exists(os.path.join(self.path, configuration_directory_name, sqlite_configuration_file_name)))
+        config = FragmentsConfig()
+        self.assertEquals(config.backend, 'sqlite')
+        self.assertEquals(dict(config['files']), {})
+        self.assertEquals(config['version'], __version__)
+        self.assertRaises(ExecutionError, init)
+
+    def test_recovery_from_corrupt_fragments_config_sqlite(self):
+        init('-b', 'sqlite')
+        with open(os.path.join(self.path, configuration_directory_name, sqlite_configuration_file_name), 'w') as corrupted_config:
+            corrupted_config.write("GIBBERISH#$$$;,){no}this=>is NOT.sqlite" * 100)
+        init()
+        self.assertEquals(FragmentsConfig().backend, 'sqlite')
+        self.assertTrue(os.path.exists(os.path.join(self.path, configuration_directory_name, sqlite_configuration_file_name + '.corrupt')))
+
 
 class TestUnicode(CommandBase):
 
@@ -349,6 +358,99 @@ class TestStatusCommand(CommandBase, PostInitCommandMixIn):
             'M\t%s' % file_name
         ])
 
+    def test_modified_large_file_same_size_status(self):
+        init()
+        contents = "0123456789abcde\n" * 10000
+        file_name, file_path = self._create_file(contents=contents)
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        os.unlink(config.index.path)
+        self.assertEquals(status(file_name)[2:], [' \t%s' % file_name])
+        os.unlink(config.index.path)
+        with open(file_path, 'w') as f:
+            f.write(contents[:-2] + "f\n")
+        self.assertEquals(status(file_name)[2:], ['M\t%s' % file_name])
+
+    def test_modified_file_same_size_different_newlines_status(self):
+        init()
+        file_name, file_path = self._create_file(contents="one\r\ntwo\n")
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        os.unlink(config.index.path)
+        with open(file_path, 'wb') as f:
+            f.write(b"one\ntwo\r\n")
+        self.assertEquals(status(file_name)[2:], ['M\t%s' % file_name])
+
+    def test_modified_file_same_size_same_mtime_status(self):
+        init()
+        file_name, file_path = self._create_file(contents="one\ntwo\n")
+        yestersecond = time.time() - 2
+        os.utime(file_path, (yestersecond, yestersecond))
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        key = os.path.relpath(file_path, config.root)
+        self.assertIn(key, config.index)
+        with open(file_path, 'w') as f:
+            f.write("two\none\n")
+        os.utime(file_path, (yestersecond, yestersecond))  # only the ctime gives the change away
+        self.assertEquals(status(file_name), [
+            'fragments configuration version %s.%s.%s' % __version__,
+            'stored in %s' % config.directory,
+            'M\t%s' % file_name
+        ])
+
+    def test_status_updates_index(self):
+        init()
+        file_name, file_path = self._create_file()
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        key = os.path.relpath(file_path, config.root)
+        self.assertNotIn('curr', config.index[key])  # just written, so the stat data can't be trusted yet
+        yestersecond = time.time() - 2
+        os.utime(file_path, (yestersecond, yestersecond))
+        self.assertEquals(status(file_name)[2:], [' \t%s' % file_name])
+        config = FragmentsConfig()
+        self.assertIn('curr', config.index[key])
+        self.assertEquals(status(file_name)[2:], [' \t%s' % file_name])
+
+    def test_touched_file_status_uses_digest(self):
+        init()
+        file_name, file_path = self._create_file(contents="one\ntwo\n")
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        key = os.path.relpath(file_path, config.root)
+        repo_path = os.path.join(config.directory, config['files'][key])
+        repo_stat = os.stat(repo_path)
+        with open(repo_path, 'r+') as repo_file:
+            repo_file.write("two\none\n")  # same size, same inode, same mtime: indistinguishable from the committed file
+        os.utime(repo_path, (repo_stat.st_atime, repo_stat.st_mtime))
+        self.assertEquals(status(file_name)[2:], [' \t%s' % file_name])  # committed file was never read
+        with open(file_path, 'w') as f:
+            f.write("two\none\n")
+        self.assertEquals(status(file_name)[2:], ['M\t%s' % file_name])
+
+    def test_missing_or_corrupt_index_status(self):
+        init()
+        file_name, file_path = self._create_file()
+        yestersecond = time.time() - 2
+        os.utime(file_path, (yestersecond, yestersecond))
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        os.unlink(config.index.path)
+        self.assertEquals(status(file_name)[2:], [' \t%s' % file_name])
+        with open(config.index.path, 'w') as index_file:
+            index_file.write("GIBBERISH#$$$;,){no}this=>is NOT.json")
+        self.assertEquals(status(file_name)[2:], [' \t%s' % file_name])
+        with open(file_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(status(file_name)[2:], ['M\t%s' % file_name])
+
     def test_removed_file_status(self):
         init()
         file_name, file_path = self._create_file()
@@ -403,6 +505,129 @@ class TestStatusCommand(CommandBase, PostInitCommandMixIn):
             ' \tbar',
         ])
 
+    def test_unknown_files_status_skips_fragments_directory(self):
+        init()
+        foo_rel, foo_path = self._create_file(file_name='foo', dir_name='foodir')
+        bar_rel, bar_path = self._create_file(file_name='bar', dir_name='bardir')
+        follow(foo_rel)
+        commit(foo_rel)
+        self.assertEquals(status('-l', '?')[2:], [
+            '?\tbardir/bar',
+        ])
+
+    def test_untracked_subtree_status(self):
+        init()
+        foo_rel, foo_path = self._create_file(file_name='foo', dir_name='foodir')
+        for i in range(3):
+            self._create_file(dir_name='node_modules')
+        follow(foo_rel)
+        os.symlink(self.path, os.path.join(self.path, 'foodir', 'loop'))
+        self.assertEquals(status()[2:], [
+            'A\tfoodir/foo',
+        ])
+        self.assertEquals(status('-l', 'A?')[2:], [
+            '?\tnode_modules/file1.ext',
+            '?\tnode_modules/file2.ext',
+            '?\tnode_modules/file3.ext',
+            'A\tfoodir/foo',
+        ])
+        os.unlink(foo_path)
+        self.assertEquals(status()[2:], [])  # as with unknown files, only files on disk are listed
+
+    def test_ignored_files_status(self):
+        init()
+        foo_rel, foo_path = self._create_file(file_name='foo.ext', dir_name='foodir')
+        self._create_file(file_name='foo.pyc', dir_name='foodir')
+        self._create_file(file_name='keep.pyc', dir_name='foodir')
+        self._create_file(file_name='module.js', dir_name='node_modules')
+        self._create_file(file_name='module.js', dir_name=os.path.join('foodir', 'build'))
+        self._create_file(file_name='build', dir_name='bardir')
+        with open(os.path.join(self.path, '.fragmentsignore'), 'w') as ignore_file:
+            ignore_file.write("# compiled files\n*.pyc\n!keep.pyc\n/node_modules\nbuild/\n.fragmentsignore\n")
+        self.assertEquals(status('-l', '?')[2:], [
+            '?\tbardir/build',
+            '?\tfoodir/foo.ext',
+            '?\tfoodir/keep.pyc',
+        ])
+        follow('.')
+        self.assertEquals(sorted(FragmentsConfig()['files']), ['bardir/build', 'foodir/foo.ext', 'foodir/keep.pyc'])
+        follow(os.path.join('foodir', 'foo.pyc'))  # naming an ignored file explicitly still follows it
+        self.assertEquals(status('-l', 'A')[2:], [
+            'A\tbardir/build',
+            'A\tfoodir/foo.ext',
+            'A\tfoodir/foo.pyc',
+            'A\tfoodir/keep.pyc',
+        ])
+
+    def test_followed_files_in_ignored_directories_status(self):
+        init()
+        x_rel, x_path = self._create_file(file_name='x.html', dir_name='vendor')
+        self._create_file(file_name='y.html', dir_name='vendor')
+        self._create_file(file_name='foo.pyc')
+        follow(x_rel, 'foo.pyc')
+        commit(x_rel, 'foo.pyc')
+        with open(x_path, 'a') as f:
+            f.write('more\n')
+        with open(os.path.join(self.path, '.fragmentsignore'), 'w') as ignore_file:
+            ignore_file.write("vendor/\n*.pyc\n.fragmentsignore\n")
+        self.assertEquals(status('-l', 'M?')[2:], [
+            'M\tvendor/x.html',
+        ])
+        self.assertEquals(status('-l', 'MDAE ?')[2:], [
+            ' \tfoo.pyc',
+            'M\tvendor/x.html',
+        ])
+
+    def test_ignore_patterns(self):
+        init()
+        with open(os.path.join(self.path, '.fragmentsignore'), 'w') as ignore_file:
+            ignore_file.write("docs/*.html\n**/tmp\nlogs/**\n\\#hash\nfile[0-9].ext\n")
+        ignore = FragmentsConfig().ignore
+        self.assertTrue(ignore.match('docs/index.html'))
+        self.assertFalse(ignore.match('docs/api/index.html'))
+        self.assertFalse(ignore.match('other/docs/index.html'))
+        self.assertTrue(ignore.match('a/b/tmp', is_dir=True))
+        self.assertTrue(ignore.match('tmp'))
+        self.assertTrue(ignore.match('logs/2012/error.log'))
+        self.assertTrue(ignore.match('#hash'))
+        self.assertTrue(ignore.match('dir/file7.ext'))
+        self.assertFalse(ignore.match('dir/fileX.ext'))
+
+    def test_stream_status(self):
+        init()
+        file_names = []
+        for file_name, dir_name in (('a.txt', ''), ('b', 'a'), ('c', 'a-b'), ('d', 'a0'), ('e', os.path.join('a', 'z')), ('a.ext', 'a')):
+            file_names.append(self._create_file(file_name=file_name, dir_name=dir_name)[0])
+        follow(*file_names[::2])
+        commit(file_names[0])
+        self.assertEquals(status('--stream', '-l', 'A ?')[2:], [
+            'A\ta-b/c',
+            ' \ta.txt',
+            '?\ta/a.ext',
+            '?\ta/b',
+            'A\ta/z/e',
+            '?\ta0/d',
+        ])
+        self.assertEquals(sorted(status('-s', '-j', '3', '-l', 'A ?')), sorted(status('-l', 'A ?')))
+        self.assertEquals(status('-s')[2:], [
+            'A\ta-b/c',
+            ' \ta.txt',
+            'A\ta/z/e',
+        ])
+
+    def test_parallel_status(self):
+        init()
+        file_names = []
+        for i in range(20):
+            file_name, file_path = self._create_file(file_name='file%02d.ext' % i, dir_name='dir%d' % (i % 3))
+            file_names.append(file_name)
+        follow(*file_names)
+        commit(*file_names[::2])
+        with open(file_names[4], 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(status('-j', '4'), status())
+        self.assertEquals(status('--jobs', '4', '-l', 'M')[2:], ['M\t%s' % file_names[4]])
+
 
 class TestFollowCommand(CommandBase, PostInitCommandMixIn):
 
@@ -1030,6 +1255,16 @@ class TestCommitCommand(CommandBase, PostInitCommandMixIn):
                     curr_file.read(),
                 )
 
+    def test_commit_records_digest(self):
+        init()
+        file_name, file_path = self._create_file()
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        key = os.path.relpath(file_path, config.root)
+        with open(file_path, 'rb') as curr_file:
+            self.assertEquals(config.index[key]['digest'], hashlib.blake2b(curr_file.read(), digest_size=16).hexdigest())
+
     def test_commit_unfollowed_file(self):
         init()
         file_name, file_path = self._create_file()
@@ -1066,6 +1301,16 @@ class TestCommitCommand(CommandBase, PostInitCommandMixIn):
             ' \tfoodir/foo',
         ])
 
+    def test_parallel_commit_subdirs(self):
+        init()
+        foo_rel, foo_path = self._create_file(file_name='foo', dir_name='foodir')
+        bar_rel, bar_path = self._create_file(file_name='bar', dir_name='bardir')
+        follow(bar_rel, foo_rel)
+        self.assertEquals(commit('-j', '2'), [
+            "'bardir/bar' committed",
+            "'foodir/foo' committed",
+        ])
+
     def test_commit_one_subdir(self):
         init()
         foo_rel, foo_path = self._create_file(file_name='foo', dir_name='foodir')
@@ -1079,6 +1324,125 @@ class TestCommitCommand(CommandBase, PostInitCommandMixIn):
             'A\tfoodir/foo',
         ])
 
+    def test_commit_objects_storage(self):
+        init('--storage', 'objects')
+        objects_path = os.path.join(self.path, configuration_directory_name, 'objects')
+        def _objects():
+            return sorted(os.path.join(d, f) for d in os.listdir(objects_path) for f in os.listdir(os.path.join(objects_path, d)))
+        file1_name, file1_path = self._create_file()
+        file2_name, file2_path = self._create_file()
+        self.assertEquals(follow(file1_name, file2_name), [
+            "'file1.ext' is now being followed",
+            "'file2.ext' is now being followed",
+        ])
+        self.assertEquals(status()[2:], ['A\tfile1.ext', 'A\tfile2.ext'])
+        commit()
+        object_id = hashlib.blake2b(b'CONTENTS\nCONTENTS\n', digest_size=16).hexdigest()
+        self.assertEquals(_objects(), [os.path.join(object_id[:2], object_id[2:])])  # identical files share one object
+        self.assertEquals(dict(FragmentsConfig()['files']), {file1_name: object_id, file2_name: object_id})
+
+        rename(file2_name, 'renamed.ext')
+        self.assertEquals(_objects(), [os.path.join(object_id[:2], object_id[2:])])
+        self.assertEquals(status()[2:], [' \tfile1.ext', ' \trenamed.ext'])
+
+        with open(file1_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(status()[2:], [' \trenamed.ext', 'M\tfile1.ext'])
+        self.assertEquals(diff()[3:], ['@@ -1,2 +1,3 @@', ' CONTENTS', ' CONTENTS', '+CHICKENS'])
+        commit(file1_name)
+        self.assertEquals(len(_objects()), 2)
+        forget('renamed.ext')
+        self.assertEquals(len(_objects()), 1)  # no followed file refers to the original contents any more
+        os.unlink(file1_path)
+        revert(file1_name)
+        with open(file1_path) as f:
+            self.assertEquals(f.read(), "CONTENTS\nCONTENTS\nCHICKENS\n")
+        self.assertEquals(status()[2:], [' \tfile1.ext'])
+
+    def test_commit_compressed(self):
+        for compression, decompress in (('zlib', zlib.decompress), ('lzma', lzma.decompress)):
+            shutil.rmtree(os.path.join(self.path, configuration_directory_name), ignore_errors=True)
+            init('--compression', compression)
+            file_name, file_path = self._create_file(file_name='file.ext', contents='CONTENTS\n' * 100)
+            follow(file_name)
+            commit(file_name)
+            config = FragmentsConfig()
+            repo_path = os.path.join(config.directory, config['files'][file_name])
+            self.assertFalse(os.path.exists(repo_path))
+            repo_path += {'zlib': '.z', 'lzma': '.xz'}[compression]
+            with open(repo_path, 'rb') as repo_file:
+                self.assertEquals(decompress(repo_file.read()), b'CONTENTS\n' * 100)
+            self.assertEquals(status()[2:], [' \tfile.ext'])
+            os.unlink(config.index.path)
+            os.utime(file_path, (0, 0))
+            self.assertEquals(status()[2:], [' \tfile.ext'])  # decompresses the committed version to compare it
+
+            with open(file_path, 'a') as f:
+                f.write("CHICKENS\n")
+            self.assertEquals(status()[2:], ['M\tfile.ext'])
+            self.assertEquals(diff()[-2:], [' CONTENTS', '+CHICKENS'])
+            revert(file_name)
+            with open(file_path) as f:
+                self.assertEquals(f.read(), 'CONTENTS\n' * 100)
+            self.assertEquals(status()[2:], [' \tfile.ext'])
+
+    def test_compressed_objects_status_does_not_decompress(self):
+        init('--storage', 'objects', '--compression', 'zlib')
+        file_name, file_path = self._create_file()
+        follow(file_name)
+        commit(file_name)
+        config = FragmentsConfig()
+        object_id = config['files'][file_name]
+        object_path = os.path.join(config.directory, 'objects', object_id[:2], object_id[2:] + '.z')
+        with open(object_path, 'wb') as object_file:
+            object_file.write(b'not zlib data')  # status must never need to read it
+        os.unlink(config.index.path)
+        self.assertEquals(status()[2:], [' \t%s' % file_name])
+        with open(file_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(status()[2:], ['M\t%s' % file_name])
+
+    def test_commit_weave_storage(self):
+        init('--storage', 'weave')
+        weaves_path = os.path.join(self.path, configuration_directory_name, 'weaves')
+        def _weave(file_name):
+            config = FragmentsConfig()
+            return config.weaves.load(_weave_path(config, os.path.relpath(os.path.realpath(file_name), config.root)))
+        page = '<html>\n<head>\n<title>%s</title>\n</head>\n<body>\n%s\n</body>\n</html>\n'
+        file_names = [self._create_file(file_name='%s.html' % n, dir_name='pages', contents=page % (n, n))[0] for n in ('one', 'two', 'three')]
+        file_names.append(self._create_file(file_name='copy.html', dir_name='pages', contents=page % ('one', 'one'))[0])
+        other_name, other_path = self._create_file(file_name='other.html', dir_name='other', contents=page % ('other', 'other'))
+        follow(other_name, *file_names)
+        commit()
+        self.assertEquals(len(os.listdir(weaves_path)), 2)  # one weave per directory
+        self.assertEquals(len(_weave(file_names[0]).parents), 3)  # identical files share a revision
+        self.assertEquals(len(_weave(file_names[0]).weave), 6 + 2 * 3)  # common lines are only stored once
+        self.assertEquals(status()[2:], [' \tother/other.html'] + [' \t%s' % f for f in sorted(file_names)])
+
+        with open(file_names[1], 'w') as f:
+            f.write(page % ('two', 'TWO'))
+        self.assertEquals(diff(file_names[1])[-5:], [' <body>', '-two', '+TWO', ' </body>', ' </html>'])
+        self.assertEquals(commit(file_names[1]), ["'%s' committed" % file_names[1]])
+        self.assertEquals(len(_weave(file_names[1]).parents), 3)  # the old revision is gone
+        os.unlink(file_names[1])
+        self.assertEquals(revert(file_names[1]), ["'%s' reverted" % file_names[1]])
+        with open(file_names[1]) as f:
+            self.assertEquals(f.read(), page % ('two', 'TWO'))
+
+        rename(file_names[2], os.path.join('pages', 'renamed.html'))
+        rename(file_names[3], os.path.join('other', 'copy.html'))  # moves the revision to the other directory's weave
+        self.assertEquals(len(_weave(file_names[0]).parents), 3)
+        self.assertEquals(len(_weave(other_name).parents), 2)
+        self.assertEquals(status('-l', 'MDA ')[2:], [
+            ' \tother/copy.html',
+            ' \tother/other.html',
+            ' \tpages/one.html',
+            ' \tpages/renamed.html',
+            ' \tpages/two.html',
+        ])
+        forget('other')
+        self.assertEquals(len(os.listdir(weaves_path)), 1)
+
 
 class TestRevertCommand(CommandBase, PostInitCommandMixIn):
 
@@ -1449,6 +1813,312 @@ class TestForkCommand(CommandBase, PostInitCommandMixIn):
         self.assertEquals(open(os.path.join(config.root, 'dirA/out-1-2')).read(), 'Line One\nLine Two\n\nLine Four\nLine Five\n')
 
 
+@unittest.skipUnless(sys.platform.startswith('linux'), "watch requires inotify")
+class TestWatchCommand(CommandBase, PostInitCommandMixIn):
+
+    command = staticmethod(lambda: next(commands.watch()))
+
+    def test_watch(self):
+        init()
+        file1_name, file1_path = self._create_file()
+        file2_name, file2_path = self._create_file()
+        follow(file1_name, file2_name)
+        commit(file1_name)
+        config = FragmentsConfig()
+        watch = commands.watch()
+        self.assertEquals([next(watch) for i in range(4)], [
+            'fragments configuration version %s.%s.%s' % __version__,
+            'watching %s' % config.directory,
+            ' \t%s' % file1_name,
+            'A\t%s' % file2_name,
+        ])
+        with open(file1_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(next(watch), 'M\t%s' % file1_name)
+        commit(file2_name)
+        self.assertEquals(next(watch), ' \t%s' % file2_name)
+        forget(file1_name)
+        self.assertEquals(next(watch), '?\t%s' % file1_name)
+        watch.close()
+
+    def test_watch_limit(self):
+        init()
+        file1_name, file1_path = self._create_file()
+        file2_name, file2_path = self._create_file()
+        follow(file1_name, file2_name)
+        commit(file1_name, file2_name)
+        watch = commands.watch('-l', 'M', file2_name)
+        self.assertEquals(len([next(watch) for i in range(2)]), 2)
+        with open(file1_path, 'a') as f:
+            f.write("CHICKENS\n")
+        with open(file2_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(next(watch), 'M\t%s' % file2_name)
+        revert(file2_name)
+        self.assertEquals(next(watch), ' \t%s' % file2_name)  # leaving the limited statuses is shown too
+        watch.close()
+
+    def test_watcher_directories(self):
+        init()
+        foo_rel, foo_path = self._create_file(file_name='foo', dir_name='foodir')
+        follow(foo_rel)
+        commit(foo_rel)
+        watcher = Watcher(FragmentsConfig())
+        try:
+            self.assertEquals(watcher.statuses, {foo_path: ' '})
+            shutil.rmtree(os.path.join(self.path, 'foodir'))
+            self.assertEquals(watcher.poll(10), [('D', foo_path)])
+            while watcher.poll(0.1):
+                pass
+            self._create_file(file_name='foo', dir_name='foodir', contents='CHANGED\n')
+            deadline = time.time() + 10  # the new directory is watched first, its file may only show up in a later poll
+            while watcher.statuses != {foo_path: 'M'} and time.time() < deadline:
+                watcher.poll(0.1)
+            self.assertEquals(watcher.statuses, {foo_path: 'M'})
+        finally:
+            watcher.close()
+
+
+class TestServeCommand(CommandBase, PostInitCommandMixIn):
+
+    command = staticmethod(lambda: serve('--stop'))
+
+    def setUp(self):
+        super(TestServeCommand, self).setUp()
+        self.server_thread = None
+
+    def tearDown(self):
+        self._stop_server()
+        super(TestServeCommand, self).tearDown()
+
+    def _start_server(self):
+        server = commands.serve()
+        self.assertEquals(next(server), "Serving fragments commands on '%s'" % os.path.join(FragmentsConfig().directory, server_socket_name))
+        self.server_thread = threading.Thread(target=lambda: list(server))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def _stop_server(self):
+        if self.server_thread is not None and self.server_thread.is_alive():
+            os.chdir(self.path)
+            serve('--stop')
+            self.server_thread.join()
+
+    def _remote(self, *args):
+        return list(_remote(_connect(), *args))
+
+    def test_serve(self):
+        init()
+        file1_name, file1_path = self._create_file()
+        file2_name, file2_path = self._create_file(dir_name='dir')
+        follow(file1_name, file2_name)
+        commit(file1_name)
+        self._start_server()
+        config = FragmentsConfig()
+        self.assertEquals(self._remote('status'), status())
+        with open(file1_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(self._remote('diff'), diff())
+        self.assertEquals(self._remote('status'), [
+            'fragments configuration version %s.%s.%s' % __version__,
+            'stored in %s' % config.directory,
+            'A\t%s' % file2_name,
+            'M\t%s' % file1_name,
+        ])
+        os.chdir(os.path.join(self.path, 'dir'))  # the server shares our working directory, and changes back to its own after each command
+        self.assertEquals(self._remote('commit'), ["'file2.ext' committed"])
+        os.chdir(os.path.join(self.path, 'dir'))
+        self.assertIsInstance(self._remote('status', '-l', 'M', '..')[2], color.Modified)
+        os.chdir(self.path)
+        self.assertEquals(serve('--stop'), ["Stopped fragments server in '%s'" % config.directory])
+        self.server_thread.join()
+        self.assertEquals(_connect(), None)
+        self.assertFalse(os.path.exists(os.path.join(config.directory, server_socket_name)))
+
+    def test_serve_interactive(self):
+        init()
+        file1_name, file1_path = self._create_file(contents="one\ntwo\n")
+        file2_name, file2_path = self._create_file(contents="one\ntwo\n")
+        follow(file1_name, file2_name)
+        commit(file1_name, file2_name)
+        with open(file1_path, 'w') as f:
+            f.write("one\nthree\n")
+        self._start_server()
+        apply = _remote(_connect(), 'apply', file1_name)
+        self.assertEquals([next(apply) for i in range(4)], ['@@ -1,2 +1,2 @@', ' one', '-two', '+three'])
+        prompt = next(apply)
+        self.assertIsInstance(prompt, color.Prompt)
+        self.assertEquals(prompt, "Apply this change? [ynadjk?] ")
+        self.assertEquals(apply.send('y'), "Changes in '%s' applied cleanly to '%s'" % (file1_name, file2_name))
+        self.assertRaises(StopIteration, next, apply)
+        with open(file2_path, 'r') as f:
+            self.assertEquals(f.read(), "one\nthree\n")
+
+    def test_serve_errors(self):
+        init()
+        self._start_server()
+        self.assertRaises(ServeError, list, commands.serve())
+        self.assertRaises(ServeError, self._remote, 'serve')
+        self.assertRaises(ServeError, self._remote, 'init')
+        connection = _connect()
+        os.chdir(tempfile.gettempdir())
+        self.assertRaises(ServeError, list, _remote(connection, 'status'))  # no fragments repository there
+        os.chdir(self.path)
+        try:
+            self._remote('status', '--bogus')
+        except SystemExit as exc:
+            self.assertEquals(exc.code, 2)
+        else:
+            self.fail("remote argument error did not exit")
+        self.assertEquals(self._remote('status')[2:], [])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "watching requires inotify")
+    def test_serve_status_from_watcher(self):
+        init()
+        file1_name, file1_path = self._create_file()
+        file2_name, file2_path = self._create_file(dir_name='dir')
+        follow(file1_name, file2_name)
+        commit(file1_name)
+        self._start_server()
+        expected_status = status()
+        with mock.patch.object(sys.modules['fragments'], '_file_status', side_effect=AssertionError("followed files are not checked again")):
+            self.assertEquals(self._remote('status'), expected_status)
+            with open(file1_path, 'a') as f:
+                f.write("CHICKENS\n")
+            self.assertEquals(self._remote('status', '-l', 'M'), expected_status[:2] + ['M\t%s' % file1_name])
+        self.assertEquals(self._remote('commit'), ["'%s' committed" % file2_name, "'%s' committed" % file1_name])
+        with mock.patch.object(sys.modules['fragments'], '_file_status', side_effect=AssertionError("followed files are not checked again")):
+            self.assertEquals(self._remote('status')[2:], [' \t%s' % file2_name, ' \t%s' % file1_name])
+
+    def test_serve_status_without_inotify(self):
+        init()
+        file1_name, file1_path = self._create_file()
+        follow(file1_name)
+        commit(file1_name)
+        with mock.patch.object(sys.modules['fragments.serve'], 'Watcher', side_effect=WatchError("Could not watch files, inotify is not available on this platform")):
+            self._start_server()
+        with open(file1_path, 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(self._remote('status'), status())
+
+    def test_serve_only_to_its_user_inside_the_repository(self):
+        init()
+        config = FragmentsConfig()
+        self._start_server()
+        self.assertEquals(stat.S_IMODE(os.stat(os.path.join(config.directory, server_socket_name)).st_mode), 0o600)
+        outside_path = tempfile.mkdtemp()
+        try:
+            connection = _connect()
+            os.chdir(outside_path)
+            try:
+                list(_remote(connection, 'status'))
+            except ServeError as exc:
+                self.assertEquals(exc.args[0], "Fragments server for '%s' can not run commands in '%s'" % (os.path.realpath(self.path), outside_path))
+            else:
+                self.fail("server ran a command outside its repository")
+        finally:
+            os.chdir(self.path)
+            os.rmdir(outside_path)
+        with mock.patch.object(sys.modules['fragments.serve'], '_peer_uid', lambda connection: os.getuid() + 1):
+            self.assertRaises(ServeError, self._remote, 'status')
+            self.assertRaises(ServeError, serve, '--stop')  # other users can't stop it either
+        self.assertEquals(self._remote('status')[2:], [])
+
+    def test_stop_without_server(self):
+        init()
+        config = FragmentsConfig()
+        self.assertEquals(serve('--stop'), ["No fragments server running in '%s'" % config.directory])
+
+
+class TestExportCommand(CommandBase, PostInitCommandMixIn):
+
+    command = staticmethod(lambda: export())
+
+    def test_export_sqlite(self):
+        init('--backend', 'sqlite')
+        file_names = [self._create_file(dir_name=dir_name)[0] for dir_name in ('foo', 'foo', 'bar', 'foobar')]
+        follow(*file_names)
+        commit(*file_names)
+        forget(file_names[1])
+        rename(file_names[2], 'moved.ext')
+        with open(file_names[0], 'a') as f:
+            f.write("CHICKENS\n")
+        self.assertEquals(status('foo')[2:], ['M\t%s' % file_names[0]])
+        self.assertEquals(status('-l', 'AD ', 'foo', 'bar')[2:], [])
+
+        config = FragmentsConfig()
+        self.assertEquals(sorted(config['files']), ['foo/file1.ext', 'foobar/file4.ext', 'moved.ext'])
+        self.assertEquals(config.followed('foo' + os.sep), ['foo/file1.ext'])
+        self.assertEquals(export(), ["Fragments configuration exported to '%s'" % os.path.join(config.directory, configuration_file_name)])
+        self.assertEquals(FragmentsConfig().backend, 'sqlite')  # the sqlite database is still used while it exists
+        os.unlink(config.path)
+        exported = FragmentsConfig()
+        self.assertEquals(exported.backend, 'json')
+        self.assertEquals(exported, dict(config, files=dict(config['files'].items())))
+        self.assertEquals(status('-l', 'MA ')[2:], [' \tfoobar/file4.ext', ' \tmoved.ext', 'M\tfoo/file1.ext'])
+
+    def test_export_json_to_file(self):
+        init()
+        file_name, file_path = self._create_file()
+        follow(file_name)
+        export('exported.json')
+        with open(os.path.join(configuration_directory_name, configuration_file_name)) as config_file:
+            with open('exported.json') as exported_file:
+                self.assertEquals(json.loads(exported_file.read()), json.loads(config_file.read()))
+
+
+class TestSearchCommand(CommandBase, PostInitCommandMixIn):
+
+    command = staticmethod(lambda: search('block.ext'))
+
+    def test_search(self):
+        init()
+        block_name, block_path = self._create_file(file_name='block.ext', contents="two\nthree")
+        file_names = [
+            self._create_file(contents="one\ntwo\nthree\nfour\n")[0],
+            self._create_file(contents="two\nthree\ntwo\nthree\n")[0],
+            self._create_file(contents="three\ntwo\n")[0],
+            self._create_file(contents="one\n")[0],
+        ]
+        follow(*file_names)
+        commit()
+        with open(file_names[3], 'a') as f:
+            f.write("two\nthree\n")
+        self.assertEquals(search(block_name), ['%s:2' % file_names[0], '%s:1' % file_names[1], '%s:3' % file_names[1], '%s:2' % file_names[3]])
+        self.assertEquals(search(block_name, file_names[1]), ['%s:1' % file_names[1], '%s:3' % file_names[1]])
+
+    def test_search_uses_committed_lines(self):
+        init()
+        block_name, block_path = self._create_file(file_name='block.ext', contents="two\n")
+        file_names = [self._create_file(contents=contents)[0] for contents in ("one\ntwo\n", "three\n")]
+        follow(*file_names)
+        commit()
+        config = FragmentsConfig()
+        self.assertEquals(config.lines.load(), {file_names[0]: set(_line_digest(l) for l in ('one', 'two')), file_names[1]: set([_line_digest('three')])})
+
+        rename(file_names[0], 'renamed.ext')
+        forget(file_names[1])
+        self.assertEquals(FragmentsConfig().lines.load(), {'renamed.ext': set(_line_digest(l) for l in ('one', 'two'))})
+        self.assertEquals(search(block_name), ['renamed.ext:2'])
+
+    def test_search_corrupt_committed_lines(self):
+        init()
+        block_name, block_path = self._create_file(file_name='block.ext', contents="two\n")
+        file_name = self._create_file(contents="one\ntwo\n")[0]
+        follow(file_name)
+        commit()
+        with open(os.path.join(self.path, configuration_directory_name, lines_file_name), 'wb') as lines_file:
+            lines_file.write(b'not a database' * 100)
+        self.assertEquals(search(block_name), ['%s:2' % file_name])
+        self.assertEquals(dict(FragmentsConfig().lines), {file_name: set(_line_digest(l) for l in ('one', 'two'))})  # rebuilt from the committed file
+
+    def test_search_nothing(self):
+        init()
+        self.assertEquals(search('block.ext'), ["Could not search for 'block.ext', it does not exist"])
+        self._create_file(file_name='block.ext', contents="")
+        self.assertEquals(search('block.ext'), ["Nothing to search for, 'block.ext' is empty"])
+
+
 class TestApplyCommand(CommandBase, PostInitCommandMixIn):
     maxDiff = None
     command = staticmethod(lambda: apply('file.ext'))
@@ -1532,6 +2202,269 @@ table {
         with open(file2_name, 'r') as file2:
             self.assertEqual(file2.read(), target_file2_contents)
 
+    def test_apply_compressed(self):
+        init('-c', 'lzma')
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        file2_name, file2_path = self._create_file(contents=self.html_file2_contents)
+        follow(file1_name, file2_name)
+        commit(file1_name, file2_name)
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        self.assertEqual(apply(file1_name, '-a')[-1], "Changes in '%s' applied cleanly to '%s'" % (file1_name, file2_name))
+        with open(file2_name, 'r') as file2:
+            self.assertEqual(file2.read(), self.html_file2_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+
+    def test_apply_weave_cache(self):
+        init()
+        cache_path = os.path.join(self.path, configuration_directory_name, 'cache')
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        file2_name, file2_path = self._create_file(contents=self.html_file2_contents)
+        follow(file1_name, file2_name)
+        commit(file1_name, file2_name)
+
+        changed_file2_contents = self.html_file2_contents.replace('<link href="default.css" />', '<link href="layout.css" />')
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        first_output = apply(file1_name, '-a')
+        def weave_names():
+            return [n for n in os.listdir(cache_path) if n != 'outcomes.json']
+        self.assertEquals(len(weave_names()), 2)  # before and after selecting changes
+        revert(file2_name)
+        self.assertEquals(apply(file1_name, '-a'), first_output)
+        self.assertEquals(len(weave_names()), 2)  # reused, not rebuilt
+
+        for cache_name in os.listdir(cache_path):
+            with open(os.path.join(cache_path, cache_name), 'wb') as cache_file:
+                cache_file.write(b'fragments weave cache 2\ncorrupt')
+        revert(file2_name)
+        self.assertEquals(apply(file1_name, '-a'), first_output)
+        with open(file2_name, 'r') as file2:
+            self.assertEqual(file2.read(), changed_file2_contents)
+
+    def test_apply_identical_targets_get_identical_results(self):
+        init()
+        file1_name, file1_path = self._create_file(contents="Title\nSame\nSame\n")
+        copy1_name, copy1_path = self._create_file(contents="Title\nSame\nSame\n")
+        other_name, other_path = self._create_file(contents="Other\nThing\n")
+        copy2_name, copy2_path = self._create_file(contents="Title\nSame\nSame\n")
+        follow(file1_name, copy1_name, other_name, copy2_name)
+        commit()
+
+        with open(file1_name, 'w') as file1:
+            file1.write("New title\nSame\nSame\n")
+        output = apply('-a', file1_name)
+        # each target is merged against the source alone, a shared weave matched copy2 against copy1's lines and skipped it
+        self.assertIn("Changes in '%s' applied cleanly to '%s'" % (file1_name, copy1_name), output)
+        self.assertIn("Changes in '%s' applied cleanly to '%s'" % (file1_name, copy2_name), output)
+        for copy_name in (copy1_name, copy2_name):
+            with open(copy_name, 'r') as copy_file:
+                self.assertEqual(copy_file.read(), "New title\nSame\nSame\n")
+
+    def test_apply_jobs(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        other_names = [self._create_file(contents=self.html_file2_contents)[0] for i in range(4)]
+        other_names.append(self._create_file(contents="Nothing in common\n")[0])
+        follow(file1_name, *other_names)
+        commit()
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        serial_output = apply(file1_name, '-a')
+        serial_contents = []
+        for other_name in other_names:
+            with open(other_name, 'r') as other_file:
+                serial_contents.append(other_file.read())
+        revert(*other_names)
+
+        self.assertEqual(apply(file1_name, '-a', '-j', '3'), serial_output)  # same messages, in the same order
+        for other_name, contents in zip(other_names, serial_contents):
+            with open(other_name, 'r') as other_file:
+                self.assertEqual(other_file.read(), contents)
+        self.assertIn("Changes in '%s' cannot apply to '%s', skipping" % (file1_name, other_names[-1]), serial_output)
+
+        with mock.patch.object(sys.modules['fragments.apply'], 'ProcessPoolExecutor', side_effect=AssertionError("no worker processes are needed")):
+            output = apply('-a', '-j', '3', file1_name, other_names[-1])  # nothing in common, so nothing to merge
+        self.assertEqual(output[-1], "Changes in '%s' cannot apply to '%s', skipping" % (file1_name, other_names[-1]))
+
+    def _recording_merges(self, merges):
+        """Patch Weave.copy, which apply calls once for each merge, to record the merges in *merges*."""
+        weave_copy = Weave.copy
+        return mock.patch.object(Weave, 'copy', lambda weave: merges.append(weave) or weave_copy(weave))
+
+    def test_apply_merges_identical_files_once(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        copy_names = [self._create_file(contents=self.html_file2_contents)[0] for i in range(3)]
+        other_name, other_path = self._create_file(contents=self.html_file2_contents.replace('Page Two', 'Page Three'))
+        follow(file1_name, other_name, *copy_names)
+        commit()
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        merges = []
+        with self._recording_merges(merges):
+            output = apply(file1_name, '-a')
+        self.assertEqual(len(merges), 2)
+        self.assertEqual(output[-4:], ["Changes in '%s' applied cleanly to '%s'" % (file1_name, n) for n in sorted(copy_names + [other_name])])
+        for copy_name in copy_names:
+            with open(copy_name, 'r') as copy_file:
+                self.assertEqual(copy_file.read(), self.html_file2_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+
+    def test_apply_skips_unrelated_files_without_merging(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        unrelated_name, unrelated_path = self._create_file(contents="Nothing in common\n")
+        empty_name, empty_path = self._create_file(contents="")
+        follow(file1_name, unrelated_name, empty_name)
+        commit()
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        merges = []
+        with self._recording_merges(merges):
+            output = apply('-a', file1_name, unrelated_name, empty_name)
+        self.assertEqual(len(merges), 1)  # only the empty file is merged
+        self.assertEqual(output[-2:], ["Changes in '%s' cannot apply to '%s', skipping" % (file1_name, n) for n in (unrelated_name, empty_name)])
+
+    def test_apply_skips_files_sharing_only_boilerplate_without_merging(self):
+        init()
+        file1_name, file1_path = self._create_file(contents="<div>\n    <p>Intro</p>\n</div>\n\n<div>\n    <p>Body</p>\n</div>\n\n<div>\n    <p>Footer</p>\n</div>\n")
+        other_names = [self._create_file(contents="<div>\n    <p>Other %d</p>\n</div>\n\n" % i)[0] for i in range(5)]
+        follow(file1_name, *other_names)
+        commit()
+        for other_name in other_names[:2]:  # modified files are read, unchanged ones are ruled out by the line index
+            with open(other_name, 'a') as other_file:
+                other_file.write("<div>\n</div>\n")
+
+        with open(file1_name, 'w') as file1:
+            file1.write("<div>\n    <p>Intro</p>\n</div>\n\n<div>\n    <p>Main body</p>\n</div>\n\n<div>\n    <p>Footer</p>\n</div>\n")
+        merges = []
+        with self._recording_merges(merges):
+            output = apply('-a', file1_name)
+        self.assertEqual(merges, [])  # the divs and blank lines appear more than once in the source, so they can't tie the change to a place
+        self.assertEqual(sorted(output[-5:]), ["Changes in '%s' cannot apply to '%s', skipping" % (file1_name, n) for n in sorted(other_names)])
+
+    def test_apply_skips_unchanged_unrelated_files_without_reading(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        file2_name, file2_path = self._create_file(contents=self.html_file2_contents)
+        unrelated_name, unrelated_path = self._create_file(contents="Nothing in common\n")
+        follow(file1_name, file2_name, unrelated_name)
+        commit()
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        apply_module = sys.modules['fragments.apply']
+        digested = []
+        file_digest = apply_module._file_digest
+        with mock.patch.object(apply_module, '_file_digest', lambda path: digested.append(os.path.relpath(path)) or file_digest(path)):
+            output = apply('-a', file1_name)
+        self.assertEqual(digested, [file2_name])
+        self.assertEqual(output[-2:], [
+            "Changes in '%s' applied cleanly to '%s'" % (file1_name, file2_name),
+            "Changes in '%s' cannot apply to '%s', skipping" % (file1_name, unrelated_name),
+        ])
+
+    def test_apply_to_file_committed_outside_of_fragments(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        file2_name, file2_path = self._create_file(contents="Nothing in common\n")
+        follow(file1_name, file2_name)
+        commit()
+
+        config = FragmentsConfig()
+        for path in (file2_path, _snapshot_path(config, file2_name)):  # as a version control checkout updating both would
+            with open(path, 'w') as f:
+                f.write(self.html_file2_contents)
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        self.assertEqual(apply('-a', file1_name)[-1], "Changes in '%s' applied cleanly to '%s'" % (file1_name, file2_name))
+        with open(file2_name, 'r') as file2:
+            self.assertEqual(file2.read(), self.html_file2_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        self.assertEqual(FragmentsConfig().lines.load()[file2_name], set(_line_digest(l) for l in self.html_file2_contents.splitlines()))
+
+    def test_apply_remembers_outcomes(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        file2_name, file2_path = self._create_file(contents=self.html_file2_contents)
+        unrelated_name, unrelated_path = self._create_file(contents="Nothing in common\n")
+        follow(file1_name, file2_name, unrelated_name)
+        commit()
+        with open(unrelated_name, 'a') as unrelated_file:
+            unrelated_file.write("Still nothing\n")
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        merges = []
+        with self._recording_merges(merges):
+            output = apply('-a', file1_name)
+            self.assertEqual(len(merges), 1)
+            file2_stat = os.stat(file2_name)
+            self.assertEqual(apply('-a', file1_name), output)
+            self.assertEqual(len(merges), 2)  # file2 has changed, so it is merged again
+            self.assertEqual(apply('-a', file1_name), output)
+            self.assertEqual(len(merges), 2)  # now file2 is known to have the changes already
+        self.assertEqual(os.stat(file2_name).st_mtime_ns, file2_stat.st_mtime_ns)  # and is not written again
+        self.assertEqual(output[-2:], [
+            "Changes in '%s' applied cleanly to '%s'" % (file1_name, file2_name),
+            "Changes in '%s' cannot apply to '%s', skipping" % (file1_name, unrelated_name),
+        ])
+        with open(os.path.join(self.path, configuration_directory_name, 'cache', 'outcomes.json')) as outcomes_file:
+            self.assertEqual(sorted(outcome for key, outcome in json.loads(outcomes_file.read())['outcomes']), ['skip', 'unchanged'])
+
+    def test_apply_all_modified(self):
+        init()
+        layout_name, layout_path = self._create_file(contents=self.html_file1_contents)
+        doctype_name, doctype_path = self._create_file(contents=self.html_file1_contents)
+        colors_name, colors_path = self._create_file(contents=self.html_file1_contents)
+        target_name, target_path = self._create_file(contents=self.html_file2_contents)
+        follow(layout_name, doctype_name, colors_name, target_name)
+        commit()
+
+        layout_contents = self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />')
+        with open(layout_name, 'w') as layout_file:
+            layout_file.write(layout_contents)
+        with open(doctype_name, 'w') as doctype_file:
+            doctype_file.write(self.html_file1_contents.replace('<!DOCTYPE html>', '<!DOCTYPE html5>'))
+        with open(colors_name, 'w') as colors_file:
+            colors_file.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="colors.css" />'))
+        self.assertEqual(apply('-a', '--all-modified')[-9:], [
+            "Changes in '%s' overlap with other changes to '%s', skipping" % (colors_name, target_name),
+            "Changes in '%s' applied cleanly to '%s'" % (layout_name, target_name),
+            "Changes in '%s' applied cleanly to '%s'" % (doctype_name, target_name),
+            # modified files are targets of each other's changes too
+            "Changes in '%s' overlap with other changes to '%s', skipping" % (colors_name, layout_name),
+            "Changes in '%s' applied cleanly to '%s'" % (doctype_name, layout_name),
+            "Changes in '%s' overlap with other changes to '%s', skipping" % (colors_name, doctype_name),
+            "Changes in '%s' applied cleanly to '%s'" % (layout_name, doctype_name),
+            "Changes in '%s' overlap with other changes to '%s', skipping" % (layout_name, colors_name),
+            "Changes in '%s' applied cleanly to '%s'" % (doctype_name, colors_name),
+        ])
+        with open(target_name, 'r') as target_file:
+            self.assertEqual(target_file.read(), self.html_file2_contents.replace(
+                '<link href="default.css" />', '<link href="layout.css" />').replace('<!DOCTYPE html>', '<!DOCTYPE html5>'))
+        for name, link in ((layout_name, 'layout.css'), (doctype_name, 'layout.css'), (colors_name, 'colors.css')):
+            with open(name, 'r') as modified_file:
+                self.assertEqual(modified_file.read(), self.html_file1_contents.replace(
+                    '<link href="default.css" />', '<link href="%s" />' % link).replace('<!DOCTYPE html>', '<!DOCTYPE html5>'))
+
+    def test_apply_all_modified_limited(self):
+        init()
+        file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
+        file2_name, file2_path = self._create_file(contents=self.html_file2_contents)
+        file3_name, file3_path = self._create_file(contents=self.html_file2_contents)
+        follow(file1_name, file2_name, file3_name)
+        commit()
+        self.assertEqual(apply('-a', '-m'), ["Could not apply changes, no files have been modified"])
+
+        with open(file1_name, 'w') as file1:
+            file1.write(self.html_file1_contents.replace('<link href="default.css" />', '<link href="layout.css" />'))
+        self.assertEqual(apply('-a', '-m', file1_name, file2_name)[-1], "Changes in '%s' applied cleanly to '%s'" % (file1_name, file2_name))
+        with open(file3_name, 'r') as file3:
+            self.assertEqual(file3.read(), self.html_file2_contents)
+
     def test_apply_to_one_file(self):
         init()
         file1_name, file1_path = self._create_file(contents=self.html_file1_contents)
@@ -7,7 +7,7 @@ from __future__ import unicode_literals
 
 import unittest
 
-from fragments.precisecodevillemerge import Weave, unique_lcs, recurse_matches
+from fragments.precisecodevillemerge import Weave, unique_lcs, recurse_matches, trimmed_matches
 
 class TestWeave(unittest.TestCase):
     def test_unique_lcs(self):
@@ -19,6 +19,7 @@ class TestWeave(unittest.TestCase):
         self.assertEquals(unique_lcs('cdeab', 'abcde'), [(0, 2), (1, 3), (2, 4)])
         self.assertEquals(unique_lcs('abXde', 'abYde'), [(0, 0), (1, 1), (3, 3), (4, 4)])
         self.assertEquals(unique_lcs('acbac', 'abc'), [(2, 1)])
+        self.assertEquals(unique_lcs('xabXde', 'abYdey', 1, 6, 0, 5), [(1, 0), (2, 1), (4, 3), (5, 4)])
 
     def test_recurse_matches(self):
         a1 = []
@@ -28,6 +29,37 @@ class TestWeave(unittest.TestCase):
         recurse_matches(['a', 'c', 'b', 'a', 'c'], ['a', 'b', 'c'], 5, 3, a2, 10)
         self.assertEquals( a2, [(0, 0), (2, 1), (4, 2)])
 
+    def test_recurse_matches_deep(self):
+        # each of these lines is only unique once the lines before it have been matched
+        a = ['u1', 'm0']
+        for j in range(1, 2000):
+            a += ['u%d' % (j + 1), 'u%d' % j]
+        a.append('u2000')
+        a1 = []
+        recurse_matches(a, a, len(a), len(a), a1, 10)
+        self.assertEquals(a1, [(i, i) for i in range(20)] + [(21, 21)])
+        a2 = []
+        recurse_matches(a, a, len(a), len(a), a2)
+        self.assertEquals(a2, [(i, i) for i in range(len(a))])
+
+    def test_trimmed_matches(self):
+        for a, b, answer in (
+            ('abXde', 'abYde', [(0, 0), (1, 1), (3, 3), (4, 4)]),
+            ('abcd', 'abXcd', [(0, 0), (1, 1), (2, 3), (3, 4)]),
+            ('abcd', 'abcd', [(0, 0), (1, 1), (2, 2), (3, 3)]),
+            ('cbb', 'bcb', [(0, 1), (1, 2)]),  # the tail appears in the middle, so nothing is trimmed
+            ('abcxdef', 'bcydexf', [(1, 0), (2, 1), (4, 3), (5, 4), (6, 6)]),
+        ):
+            a1 = []
+            trimmed_matches(a, b, len(a), len(b), a1, 10)
+            self.assertEquals(a1, answer)
+            a2 = []
+            recurse_matches(a, b, len(a), len(b), a2, 10)
+            self.assertEquals(a1, a2)
+        a3 = [(0, 0)]
+        trimmed_matches('aXbcYd', 'aZbcd', 6, 5, a3, 10)
+        self.assertEquals(a3, [(0, 0), (2, 2), (3, 3), (5, 4)])
+
     def test_weave1(self):
         w = Weave()
         w.add_revision(1, ['a', 'b'], [])
@@ -252,3 +284,75 @@ class TestWeave(unittest.TestCase):
         w.add_revision(2, ['a', 'b', 'c', 'e', 'f'], [1])
         w.add_revision(3, ['a', 'b', 'd', 'e', 'f'], [1])
         self.assertEquals(w.merge(2, 3), ['a', 'b', (['c'], ['d']), 'e', 'f'])
+
+    def test_weave_interns_lines(self):
+        import json
+        w = Weave()
+        w.add_revision(1, ['a\n', 'b\n', 'a\n'], [])
+        w.add_revision(2, ['b\n', 'a\n', 'c\n'], [1])
+        self.assertEquals(sorted(w.symbols), ['a\n', 'b\n', 'c\n'])
+        self.assertTrue(w.weave[0][1] is w.weave[2][1])  # equal lines share one string
+        self.assertEquals(w.weave_symbols, [w.symbols[line] for (lineid, line) in w.weave])
+        w2 = Weave.from_dict(json.loads(json.dumps(w.to_dict()))).copy()  # symbols are rebuilt for loaded weaves
+        w2.add_revision(3, ['b\n', 'a\n', 'd\n'], [])
+        self.assertEquals(w2.cherry_pick(2, 3), ['b\n', 'a\n', (['c\n'], ['d\n'])])
+        self.assertEquals(sorted(w.symbols), ['a\n', 'b\n', 'c\n'])
+
+    def test_weave_remove_revision_and_prune(self):
+        w = Weave()
+        w.add_revision(1, ['a', 'b', 'c'], [])
+        w.add_revision(2, ['a', 'x', 'c'], [])
+        w.add_revision(3, ['a', 'y', 'c'], [2])
+        self.assertRaises(AssertionError, w.remove_revision, 2)
+        w.remove_revision(1)
+        w.prune()
+        self.assertEquals([line for (lineid, line) in w.weave], ['a', 'x', 'y', 'c'])
+        self.assertEquals(w.retrieve_revision(2), ['a', 'x', 'c'])
+        self.assertEquals(w.retrieve_revision(3), ['a', 'y', 'c'])
+        self.assertEquals(w.merge(2, 3), ['a', 'y', 'c'])
+
+    def test_weave_to_and_from_dict(self):
+        import json
+        w = Weave()
+        w.add_revision(1, ['a', 'b', 'c', 'd', 'e', 'f'], [])
+        w.add_revision(2, ['a', 'b', 'c', 'd', 'e', 'g'], [1])
+        w.add_revision(3, [], [])
+        w.add_revision(4, ['a', 'b', 'c', 'd', 'f'], [])
+        w2 = Weave.from_dict(json.loads(json.dumps(w.to_dict())))
+        self.assertEquals(w2.weave, w.weave)
+        self.assertEquals(w2.parents, w.parents)
+        self.assertEquals(w2.newedgestates, w.newedgestates)
+        self.assertEquals(w2.cherry_pick(2, 4), ['a', 'b', 'c', 'd', (['e', 'g'], ['f'])])
+        w2.add_revision(5, ['a', 'b', 'c', 'd', 'e', 'f'], [])
+        self.assertEquals(w2.retrieve_revision(5), ['a', 'b', 'c', 'd', 'e', 'f'])
+
+    def test_weave_to_and_from_dict_stores_revision_ids_once(self):
+        import json
+        w = Weave()
+        w.add_revision('first', ['a', 'b'], [])
+        w.add_revision('second', ['a', 'c'], ['first'])
+        d = w.to_dict()
+        self.assertEquals(d['revisions'], ['first', 'second'])
+        self.assertEquals(d['weave'], [[[0, 0], 'a'], [[0, 1], 'b'], [[1, 1], 'c']])
+        old_d = {  # written before revision ids were stored by index
+            'weave': [[['first', 0], 'a'], [['first', 1], 'b'], [['second', 1], 'c']],
+            'parents': [['first', []], ['second', ['first']]],
+            'newedgestates': [[revid, [[None if ida is None else list(ida), None if idb is None else list(idb), state] for ((ida, idb), state) in edgestates]] for (revid, edgestates) in w.newedgestates.items()],
+        }
+        for loaded in (Weave.from_dict(json.loads(json.dumps(d))), Weave.from_dict(json.loads(json.dumps(old_d)))):
+            self.assertEquals(loaded.weave, w.weave)
+            self.assertEquals(loaded.parents, w.parents)
+            self.assertEquals(loaded.newedgestates, w.newedgestates)
+            self.assertEquals(loaded.retrieve_revision('second'), ['a', 'c'])
+
+    def test_weave_copy(self):
+        w = Weave()
+        w.add_revision(1, ['a', 'b', 'c', 'd', 'e', 'f'], [])
+        w.add_revision(2, ['a', 'b', 'c', 'd', 'e', 'g'], [1])
+        w2 = w.copy()
+        w2.add_revision(3, ['a', 'b', 'c', 'd', 'f', 'x'], [])
+        self.assertEquals(w2.cherry_pick(2, 3), ['a', 'b', 'c', 'd', (['e', 'g'], ['f', 'x'])])
+        self.assertEquals(sorted(w.parents), [1, 2])
+        self.assertEquals(len(w.weave), 7)
+        w.add_revision(3, ['a', 'b', 'c', 'd', 'f'], [])  # the same revision id can be reused in the original
+        self.assertEquals(w.cherry_pick(2, 3), ['a', 'b', 'c', 'd', (['e', 'g'], ['f'])])